@@ -0,0 +1,331 @@
+"""A local stand-in for the parts of the Notion API this app uses.
+
+Serves data source queries (filters, sorts, cursor pagination, filter_properties), page retrieval
+and page updates from memory, with configurable latency and injected 429 responses. Pages can also
+be edited or trashed directly, as if changed in Notion, to go with replayed webhook events. Point
+the app at it with NOTION_BASE_URL.
+"""
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TASKS_ID = "tasks"
+PROJECTS_ID = "projects"
+
+PRIORITIES = ("High", "Medium", "Low", "Optional", None)
+
+# property name -> (property id, type) for each data source
+TASK_SCHEMA = {
+    "Name": ("title", "title"),
+    "Project": ("prj", "relation"),
+    "Priority": ("pri", "select"),
+    "Planned start": ("pst", "date"),
+    "Due date": ("due", "date"),
+    "Description": ("dsc", "rich_text"),
+    "Printed": ("prt", "checkbox"),
+    "Done": ("don", "status"),
+}
+PROJECT_SCHEMA = {
+    "Name": ("title", "title"),
+    "Archive": ("arc", "checkbox"),
+}
+
+
+def _now():
+    # Notion reports last_edited_time rounded down to the minute
+    return datetime.now(timezone.utc).replace(second=0, microsecond=0).isoformat().replace("+00:00", ".000Z")
+
+
+def _text(value):
+    return [{"type": "text", "plain_text": value, "text": {"content": value}}] if value else []
+
+
+def _property(schema, name, value):
+    prop_id, kind = schema[name]
+    if kind in ("title", "rich_text"):
+        content = _text(value)
+    elif kind == "relation":
+        content = [{"id": value}] if value else []
+    elif kind in ("select", "status"):
+        content = {"name": value} if value else None
+    elif kind == "date":
+        content = {"start": value, "end": None} if value else None
+    else:
+        content = bool(value)
+    return {"id": prop_id, "type": kind, kind: content}
+
+
+def _page(page_id, schema, values, data_source_id):
+    now = _now()
+    return {
+        "object": "page",
+        "id": page_id,
+        "created_time": now,
+        "last_edited_time": now,
+        "archived": False,
+        "in_trash": False,
+        "parent": {"type": "data_source_id", "data_source_id": data_source_id},
+        "properties": {name: _property(schema, name, values.get(name)) for name in schema},
+    }
+
+
+def _value(prop):
+    """The comparable value of a page property, as the filters and sorts see it."""
+    kind = prop["type"]
+    content = prop.get(kind)
+    if kind in ("title", "rich_text"):
+        return "".join(t["plain_text"] for t in content) or None
+    if kind in ("select", "status"):
+        return content["name"] if content else None
+    if kind == "date":
+        return content["start"][:10] if content else None
+    if kind == "relation":
+        return [r["id"] for r in content] or None
+    return content
+
+
+def _compare(value, condition):
+    for op, expected in condition.items():
+        if op == "equals" and value != expected:
+            return False
+        if op == "does_not_equal" and value == expected:
+            return False
+        if op == "is_empty" and (value is None) != bool(expected):
+            return False
+        if op == "is_not_empty" and (value is None) == bool(expected):
+            return False
+        if op == "contains" and (value is None or expected not in value):
+            return False
+        if op in ("before", "after", "on_or_before", "on_or_after"):
+            if value is None:
+                return False
+            expected = expected[:len(value)]
+            if op == "before" and not value < expected:
+                return False
+            if op == "after" and not value > expected:
+                return False
+            if op == "on_or_before" and not value <= expected:
+                return False
+            if op == "on_or_after" and not value >= expected:
+                return False
+    return True
+
+
+def _matches(page, filter_dict):
+    if not filter_dict:
+        return True
+    if "and" in filter_dict:
+        return all(_matches(page, f) for f in filter_dict["and"])
+    if "or" in filter_dict:
+        return any(_matches(page, f) for f in filter_dict["or"])
+    if "timestamp" in filter_dict:
+        name = filter_dict["timestamp"]
+        return _compare(page[name], filter_dict[name])
+    prop = page["properties"][filter_dict["property"]]
+    return _compare(_value(prop), filter_dict[prop["type"]])
+
+
+def _sort(pages, sorts):
+    for s in reversed(sorts or []):
+        if "timestamp" in s:
+            key = lambda p, name=s["timestamp"]: p[name]
+            pages.sort(key=key, reverse=s.get("direction") == "descending")
+            continue
+        values = [(_value(p["properties"][s["property"]]), p) for p in pages]
+        # empty values go last either way, like Notion
+        present = [v for v in values if v[0] is not None]
+        present.sort(key=lambda v: v[0], reverse=s.get("direction") == "descending")
+        pages[:] = [p for _, p in present] + [p for v, p in values if v is None]
+    return pages
+
+
+def _project(page, filter_properties):
+    """The page with only the properties named (by id or name) in filter_properties, if given."""
+    wanted = set(filter_properties or ())
+    if not wanted:
+        return page
+    return {**page, "properties": {n: v for n, v in page["properties"].items() if v["id"] in wanted or n in wanted}}
+
+
+class FakeNotion:
+    """In-memory Notion workspace with one tasks and one projects data source, served over HTTP.
+
+    latency: seconds added to every request (plus up to `jitter` more, at random).
+    page_size: largest page a query returns, whatever the client asks for.
+    rate_limit: requests per second above which requests get a 429 (0 disables).
+    error_rate: probability that any request gets a 429 regardless of the rate.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, page_size=100, rate_limit=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.pages = {}
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._window = []
+        self._server = None
+
+    def seed(self, tasks=100, projects=5, done=0, printed=0, rng=None):
+        """Fill the workspace with `tasks` open, unprinted tasks plus `done` finished and `printed` printed ones."""
+        rng = rng or random.Random(0)
+        today = date.today()
+        project_ids = [f"project-{i:04d}" for i in range(projects)]
+        for i, pid in enumerate(project_ids):
+            self.pages[pid] = _page(pid, PROJECT_SCHEMA, {"Name": f"Project {i}", "Archive": False}, PROJECTS_ID)
+
+        def task(i, is_done, is_printed):
+            due = today + timedelta(days=rng.randint(-5, 30)) if rng.random() < 0.8 else None
+            planned = today - timedelta(days=rng.randint(0, 10)) if rng.random() < 0.5 else None
+            words = rng.randint(0, 60)
+            return _page(f"task-{i:06d}", TASK_SCHEMA, {
+                "Name": f"Task {i} " + "lorem " * rng.randint(1, 12),
+                "Project": rng.choice(project_ids) if project_ids and rng.random() < 0.9 else None,
+                "Priority": rng.choice(PRIORITIES),
+                "Planned start": planned.isoformat() if planned else None,
+                "Due date": due.isoformat() if due else None,
+                "Description": " ".join(["ipsum"] * words),
+                "Printed": is_printed,
+                "Done": "Done" if is_done else "Not started",
+            }, TASKS_ID)
+
+        n = 0
+        for count, is_done, is_printed in ((tasks, False, False), (done, True, True), (printed, False, True)):
+            for _ in range(count):
+                page = task(n, is_done, is_printed)
+                self.pages[page["id"]] = page
+                n += 1
+        return self
+
+    def edit(self, page_id, values):
+        """Change page properties (by property name) as if edited in Notion, and return the page."""
+        with self._lock:
+            page = self.pages[page_id]
+            schema = TASK_SCHEMA if page["parent"]["data_source_id"] == TASKS_ID else PROJECT_SCHEMA
+            for name, value in values.items():
+                page["properties"][name] = _property(schema, name, value)
+            page["last_edited_time"] = _now()
+            return page
+
+    def trash(self, page_id):
+        """Move a page to the trash; it can still be retrieved, but queries no longer return it."""
+        with self._lock:
+            page = self.pages[page_id]
+            page["in_trash"] = page["archived"] = True
+            page["last_edited_time"] = _now()
+            return page
+
+    # HTTP
+
+    def start(self, host="127.0.0.1", port=0):
+        """Serve on a background thread and return the base URL to use as NOTION_BASE_URL."""
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _throttled(self):
+        with self._lock:
+            if self.error_rate and random.random() < self.error_rate:
+                return True
+            if not self.rate_limit:
+                return False
+            now = time.monotonic()
+            self._window = [t for t in self._window if now - t < 1.0]
+            if len(self._window) >= self.rate_limit:
+                return True
+            self._window.append(now)
+            return False
+
+    def handle(self, method, path, query, body):
+        """Return (status, payload, headers) for one API request."""
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        if self._throttled():
+            self.requests["throttled"] += 1
+            return 429, {"object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited"}, {"Retry-After": str(self.retry_after)}
+
+        parts = path.strip("/").split("/")[1:]  # drop the "v1" prefix
+        if parts[:1] == ["data_sources"] and len(parts) == 3 and parts[2] == "query" and method == "POST":
+            self.requests[f"query:{parts[1]}"] += 1
+            return 200, self._query(parts[1], query, body), {}
+        if parts[:1] == ["data_sources"] and len(parts) == 2 and method == "GET":
+            self.requests["retrieve_data_source"] += 1
+            schema = TASK_SCHEMA if parts[1] == TASKS_ID else PROJECT_SCHEMA
+            return 200, {"object": "data_source", "id": parts[1], "properties": {
+                name: {"id": prop_id, "name": name, "type": kind} for name, (prop_id, kind) in schema.items()
+            }}, {}
+        if parts[:1] == ["pages"] and len(parts) == 2:
+            page = self.pages.get(parts[1])
+            if page is None:
+                return 404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"}, {}
+            if method == "GET":
+                self.requests["retrieve_page"] += 1
+                return 200, _project(page, query.get("filter_properties")), {}
+            if method == "PATCH":
+                self.requests["update_page"] += 1
+                with self._lock:
+                    for name, value in (body.get("properties") or {}).items():
+                        page["properties"][name].update(value)
+                    page["last_edited_time"] = _now()
+                return 200, page, {}
+        return 400, {"object": "error", "status": 400, "code": "invalid_request_url", "message": f"{method} {path}"}, {}
+
+    def _query(self, data_source_id, query, body):
+        with self._lock:
+            pages = [p for p in self.pages.values()
+                     if p["parent"]["data_source_id"] == data_source_id and not p["in_trash"] and _matches(p, body.get("filter"))]
+        _sort(pages, body.get("sorts"))
+        start = int(body.get("start_cursor") or 0)
+        size = min(int(body.get("page_size") or 100), self.page_size)
+        chunk = pages[start:start + size]
+        chunk = [_project(p, query.get("filter_properties")) for p in chunk]
+        more = start + size < len(pages)
+        return {"object": "list", "results": chunk, "has_more": more, "next_cursor": str(start + size) if more else None}
+
+
+def _handler(notion):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _serve(self, method):
+            url = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+            status, payload, headers = notion.handle(method, url.path, parse_qs(url.query), body)
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._serve("GET")
+
+        def do_POST(self):
+            self._serve("POST")
+
+        def do_PATCH(self):
+            self._serve("PATCH")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,74 @@
+"""A local stand-in for a network ESC/POS printer.
+
+Accepts raw TCP connections like a printer on port 9100, records what it receives and, if asked,
+reads no faster than a real printer would print. Real-time status requests (DLE EOT n) are
+answered with an "online, no error" byte.
+"""
+import time
+import socket
+import threading
+import socketserver
+
+CUT = b"\x1dV"
+STATUS_REQUEST = b"\x10\x04"
+STATUS_OK = b"\x12"
+
+
+class FakePrinter:
+    """bytes_per_second: how fast data is drained (0 = as fast as it arrives)."""
+
+    def __init__(self, bytes_per_second=0):
+        self.bytes_per_second = bytes_per_second
+        self.connections = 0
+        self.bytes = 0
+        # monotonic time of every paper cut, i.e. every finished receipt
+        self.cuts = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self, host="127.0.0.1", port=0):
+        """Listen on a background thread and return (host, port) to use as PRINTER_IP/PRINTER_PORT."""
+        self._server = socketserver.ThreadingTCPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return host, self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self):
+        with self._lock:
+            return {"connections": self.connections, "bytes": self.bytes, "receipts": len(self.cuts)}
+
+    def _received(self, data, tail):
+        with self._lock:
+            self.bytes += len(data)
+            # count cuts across chunk boundaries by looking at the previous chunk's last byte too
+            self.cuts.extend([time.monotonic()] * (tail + data).count(CUT))
+
+
+def _handler(printer):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            with printer._lock:
+                printer.connections += 1
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            tail = b""
+            while True:
+                try:
+                    data = self.request.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                printer._received(data, tail)
+                for _ in range((tail + data).count(STATUS_REQUEST)):
+                    self.request.sendall(STATUS_OK)
+                tail = data[-1:]
+                if printer.bytes_per_second:
+                    time.sleep(len(data) / printer.bytes_per_second)
+
+    return Handler
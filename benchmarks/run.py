@@ -0,0 +1,402 @@
+"""Offline benchmarks for SC Task Receipts.
+
+Each scenario runs in a fresh process against a local Notion stand-in (fake_notion.py) and an
+ESC/POS sink (fake_printer.py), with the app served by uvicorn on a random port. Results are
+printed (or written with --output) as JSON so runs can be diffed for regressions.
+
+    python -m benchmarks.run
+    python -m benchmarks.run --scenarios print --sizes 100 --latency 0.2 --output before.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import asyncio
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime, timezone
+
+# same layout as `uvicorn --app-dir src`
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+
+from benchmarks.fake_notion import FakeNotion, TASKS_ID, PROJECTS_ID
+from benchmarks.fake_printer import FakePrinter
+from benchmarks.webhook_replayer import page_event, encode
+
+SCENARIOS = ("tasks_polling", "print", "summary", "cold_start", "webhooks")
+
+# The webhooks scenario slows the task mirror's polling right down, so changes only show up
+# through the replayed events.
+WEBHOOK_SECRET = "benchmark"
+WEBHOOK_ENV = {"NOTION_WEBHOOK_SECRET": WEBHOOK_SECRET, "TASK_SYNC_INTERVAL": "3600", "TASK_MAX_STALENESS": "3600"}
+
+# The app's write throttle (3/s) would dominate large print scenarios; it is raised here so they
+# measure the app itself. Pass --env NOTION_WRITE_RATE=3 to include it.
+DEFAULT_ENV = {
+    "NOTION_WRITE_RATE": "100",
+}
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values (0 < p <= 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered) / 100) - 1)]
+
+
+def summarize(latencies, elapsed=None):
+    """Count, throughput and latency percentiles (ms) for a list of latencies in seconds."""
+    out = {"count": len(latencies)}
+    if elapsed:
+        out["throughput_per_s"] = round(len(latencies) / elapsed, 2)
+    if latencies:
+        out.update({
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(max(latencies) * 1000, 2),
+        })
+    return out
+
+
+# Worker side: runs inside the scenario's own process
+
+class Harness:
+    """Fake Notion + fake printer + the app served by uvicorn, wired together through env vars."""
+
+    def __init__(self, params):
+        self.params = params
+        self.notion = FakeNotion(
+            latency=params["latency"],
+            jitter=params["jitter"],
+            page_size=params["page_size"],
+            rate_limit=params["rate_limit"],
+            error_rate=params["error_rate"],
+        ).seed(tasks=params["tasks"], projects=params["projects"], done=params["done"])
+        self.printer = FakePrinter(bytes_per_second=params["print_speed"])
+        self._tmp = tempfile.TemporaryDirectory()
+        self._server = None
+        self.url = None
+
+    def start_fakes(self):
+        notion_url = self.notion.start()
+        printer_host, printer_port = self.printer.start()
+        os.environ.update({
+            "NOTION_TOKEN": "benchmark",
+            "NOTION_TASKS_ID": TASKS_ID,
+            "NOTION_PROJECTS_ID": PROJECTS_ID,
+            "NOTION_BASE_URL": notion_url,
+            "PRINTER_IP": printer_host,
+            "PRINTER_PORT": str(printer_port),
+            "DB_PATH": str(Path(self._tmp.name) / "benchmark.sqlite3"),
+            **DEFAULT_ENV,
+            **self.params["env"],
+        })
+
+    def start_app(self):
+        import uvicorn
+        from sc_task_receipts.main import app
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on")
+        self._server = uvicorn.Server(config)
+        threading.Thread(target=self._server.run, daemon=True).start()
+        while not self._server.started:
+            time.sleep(0.005)
+        self.url = f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+        self.notion.stop()
+        self.printer.stop()
+        self._tmp.cleanup()
+
+
+async def _wait_for_job(client, job_id, poll=0.02):
+    while True:
+        job = (await client.get(f"/api/v1/jobs/{job_id}")).json()["data"]
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(poll)
+
+
+async def tasks_polling(harness):
+    """Many dashboards polling /api/v1/tasks at once, each sending its last ETag like a browser."""
+    import httpx
+
+    params = harness.params
+    latencies, statuses = [], {}
+    async with httpx.AsyncClient(base_url=harness.url, timeout=60) as client:
+        (await client.get("/api/v1/tasks")).raise_for_status()
+        before = dict(harness.notion.requests)
+        deadline = time.perf_counter() + params["duration"]
+
+        async def poller():
+            etag = None
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                r = await client.get("/api/v1/tasks", headers={"If-None-Match": etag} if etag else {})
+                latencies.append(time.perf_counter() - started)
+                statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                etag = r.headers.get("etag", etag)
+                if params["poll_interval"]:
+                    await asyncio.sleep(params["poll_interval"])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(poller() for _ in range(params["clients"])))
+        elapsed = time.perf_counter() - started
+    return {
+        "clients": params["clients"],
+        "tasks": params["tasks"],
+        **summarize(latencies, elapsed),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "notion_requests": _delta(before, harness.notion.requests),
+    }
+
+
+async def print_batch(harness):
+    """POST /api/v1/tasks/print for every open task and wait for the job to finish."""
+    import httpx
+
+    async with httpx.AsyncClient(base_url=harness.url, timeout=600) as client:
+        (await client.get("/api/v1/tasks")).raise_for_status()
+        before = dict(harness.notion.requests)
+        first_cut = len(harness.printer.cuts)
+        started = time.perf_counter()
+        r = await client.post("/api/v1/tasks/print")
+        r.raise_for_status()
+        accepted = time.perf_counter() - started
+        job = await _wait_for_job(client, r.json()["job_id"])
+        elapsed = time.perf_counter() - started
+    cuts = harness.printer.cuts[first_cut:]
+    gaps = [b - a for a, b in zip(cuts, cuts[1:])]
+    return {
+        "tasks": harness.params["tasks"],
+        "job_status": job["status"],
+        "progress": job["progress"],
+        "accepted_ms": round(accepted * 1000, 2),
+        "total_s": round(elapsed, 3),
+        "receipts_per_s": round(len(cuts) / elapsed, 2) if elapsed else None,
+        "between_receipts": summarize(gaps),
+        "printer": harness.printer.stats(),
+        "notion_requests": _delta(before, harness.notion.requests),
+    }
+
+
+async def summary(harness):
+    """Print the todo summary receipt `repeat` times, one job after another."""
+    import httpx
+
+    latencies = []
+    async with httpx.AsyncClient(base_url=harness.url, timeout=600) as client:
+        (await client.get("/api/v1/tasks")).raise_for_status()
+        before = dict(harness.notion.requests)
+        started_all = time.perf_counter()
+        for _ in range(harness.params["repeat"]):
+            started = time.perf_counter()
+            r = await client.post("/api/v1/tasks/summary/print")
+            r.raise_for_status()
+            job = await _wait_for_job(client, r.json()["job_id"])
+            if job["status"] != "done":
+                raise RuntimeError(f"Summary job failed: {job['error']}")
+            latencies.append(time.perf_counter() - started)
+        elapsed = time.perf_counter() - started_all
+    return {
+        "tasks": harness.params["tasks"],
+        **summarize(latencies, elapsed),
+        "printer": harness.printer.stats(),
+        "notion_requests": _delta(before, harness.notion.requests),
+    }
+
+
+async def webhooks(harness):
+    """Edit or trash tasks in the fake Notion, replay the matching webhook event and time how long
+    until /api/v1/tasks shows the change (polling alone would take TASK_SYNC_INTERVAL).
+    """
+    import httpx
+
+    latencies, applied = [], {}
+    async with httpx.AsyncClient(base_url=harness.url, timeout=60) as client:
+        tasks = (await client.get("/api/v1/tasks")).json()["data"]
+        before = dict(harness.notion.requests)
+        for i, task in enumerate(tasks[:harness.params["repeat"] * 2]):
+            started = time.perf_counter()
+            if i % 2:
+                harness.notion.trash(task["id"])
+                event, expect = page_event("page.deleted", task["id"], TASKS_ID), None
+            else:
+                title = f"Renamed {i}"
+                harness.notion.edit(task["id"], {"Name": title})
+                event, expect = page_event("page.properties_updated", task["id"], TASKS_ID), title
+            body, headers = encode(event, WEBHOOK_SECRET)
+            r = await client.post("/api/v1/webhooks/notion", content=body, headers=headers)
+            r.raise_for_status()
+            result = r.json()["message"]
+            applied[result] = applied.get(result, 0) + 1
+            while True:
+                current = {t["id"]: t["title"] for t in (await client.get("/api/v1/tasks")).json()["data"]}
+                if current.get(task["id"]) == expect:
+                    break
+                if time.perf_counter() - started > 10:
+                    raise RuntimeError(f"{event['type']} for {task['id']} not visible after 10s")
+                await asyncio.sleep(0.01)
+            latencies.append(time.perf_counter() - started)
+    return {
+        "tasks": harness.params["tasks"],
+        "change_visible": summarize(latencies),
+        "responses": applied,
+        "notion_requests": _delta(before, harness.notion.requests),
+    }
+
+
+def _delta(before, after):
+    return {k: after[k] - before.get(k, 0) for k in sorted(after) if after[k] - before.get(k, 0)}
+
+
+def run_worker(name, params):
+    harness = Harness(params)
+    harness.start_fakes()
+    try:
+        if name == "cold_start":
+            return cold_start(harness)
+        harness.start_app()
+        scenario = {"tasks_polling": tasks_polling, "print": print_batch, "summary": summary, "webhooks": webhooks}[name]
+        return asyncio.run(scenario(harness))
+    finally:
+        harness.stop()
+
+
+def cold_start(harness):
+    """Import the app, start it and serve the first /api/v1/tasks, all in a new process."""
+    import httpx
+
+    started = time.perf_counter()
+    import sc_task_receipts.main  # noqa: F401
+    imported = time.perf_counter()
+    harness.start_app()
+    serving = time.perf_counter()
+    httpx.get(f"{harness.url}/api/v1/tasks", timeout=60).raise_for_status()
+    first_response = time.perf_counter()
+    return {
+        "import_ms": round((imported - started) * 1000, 2),
+        "startup_ms": round((serving - started) * 1000, 2),
+        "first_response_ms": round((first_response - started) * 1000, 2),
+        "notion_requests": dict(harness.notion.requests),
+    }
+
+
+# Parent side: spawns one process per scenario run and collects the results
+
+def _spawn(name, params):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    try:
+        proc = subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--worker", name, "--params", json.dumps(params), "--result", result_path],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            return {"error": (proc.stderr or proc.stdout).strip().splitlines()[-1:] or [f"exit code {proc.returncode}"]}
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_path)
+
+
+def _parse_env(values):
+    env = {}
+    for item in values:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise SystemExit(f"--env expects KEY=VALUE, got {item!r}")
+        env[key] = value
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--sizes", default="10,100,1000", help="task counts for the print scenario")
+    parser.add_argument("--tasks", type=int, default=200, help="open tasks for the polling, summary and cold start scenarios")
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--done", type=int, default=0, help="extra finished tasks in the workspace")
+    parser.add_argument("--clients", type=int, default=20, help="concurrent pollers")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of polling")
+    parser.add_argument("--poll-interval", type=float, default=0, help="seconds each poller waits between requests")
+    parser.add_argument("--repeat", type=int, default=5, help="summary prints / cold starts per run")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds added to every Notion request")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many extra seconds per Notion request")
+    parser.add_argument("--page-size", type=int, default=100, help="largest page a Notion query returns")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Notion requests per second before 429s (0 = off)")
+    parser.add_argument("--error-rate", type=float, default=0, help="probability of a 429 on any Notion request")
+    parser.add_argument("--print-speed", type=int, default=0, help="printer drain rate in bytes/s (0 = unlimited)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app environment, repeatable")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--params", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        result = run_worker(args.worker, json.loads(args.params))
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    params = {
+        "tasks": args.tasks, "projects": args.projects, "done": args.done,
+        "clients": args.clients, "duration": args.duration, "poll_interval": args.poll_interval, "repeat": args.repeat,
+        "latency": args.latency, "jitter": args.jitter, "page_size": args.page_size,
+        "rate_limit": args.rate_limit, "error_rate": args.error_rate, "print_speed": args.print_speed,
+        "env": _parse_env(args.env),
+    }
+    results = {}
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}, expected one of: {', '.join(SCENARIOS)}")
+        print(f"Running {name}...", file=sys.stderr)
+        if name == "print":
+            for size in [int(s) for s in args.sizes.split(",")]:
+                results[f"print_{size}"] = _spawn(name, {**params, "tasks": size})
+        elif name == "cold_start":
+            runs = [_spawn(name, params) for _ in range(args.repeat)]
+            ok = [r for r in runs if "error" not in r]
+            results[name] = {"runs": len(runs), "errors": [r["error"] for r in runs if "error" in r]}
+            for metric in ("import_ms", "startup_ms", "first_response_ms"):
+                values = [r[metric] / 1000 for r in ok]
+                results[name][metric] = {k: v for k, v in summarize(values).items() if k != "count"}
+        elif name == "webhooks":
+            results[name] = _spawn(name, {**params, "env": {**WEBHOOK_ENV, **params["env"]}})
+        else:
+            results[name] = _spawn(name, params)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
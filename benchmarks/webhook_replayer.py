@@ -0,0 +1,93 @@
+"""Replay Notion webhook events against a running app, signed like Notion signs them.
+
+Events are read from a JSON Lines file (one event per line, e.g. deliveries captured from a real
+subscription) and POSTed in order to the app's webhook endpoint. Nothing talks to Notion itself.
+
+    python -m benchmarks.webhook_replayer events.jsonl --secret "$NOTION_WEBHOOK_SECRET"
+    python -m benchmarks.webhook_replayer events.jsonl --url http://127.0.0.1:8000/api/v1/webhooks/notion --delay 0.5
+"""
+import os
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+DEFAULT_URL = "http://127.0.0.1:8000/api/v1/webhooks/notion"
+
+
+def page_event(kind, page_id, data_source_id=None):
+    """Build a Notion page event such as "page.properties_updated" for page_id."""
+    parent = {"id": data_source_id, "type": "data_source", "data_source_id": data_source_id} if data_source_id else {}
+    return {
+        "id": str(uuid.uuid4()),
+        "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+        "workspace_id": "replayer",
+        "subscription_id": "replayer",
+        "integration_id": "replayer",
+        "type": kind,
+        "authors": [],
+        "attempt_number": 1,
+        "entity": {"id": page_id, "type": "page"},
+        "data": {"parent": parent} if parent else {},
+    }
+
+
+def sign(body, secret):
+    """Notion's X-Notion-Signature: HMAC-SHA256 of the raw body, keyed with the verification token."""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def encode(event, secret):
+    """Return (body, headers) for delivering event, signed with secret."""
+    body = json.dumps(event, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if secret:
+        headers["X-Notion-Signature"] = sign(body, secret)
+    return body, headers
+
+
+def deliver(url, event, secret, timeout=30):
+    """POST one event and return (status, response body)."""
+    body, headers = encode(event, secret)
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+def replay(url, events, secret, delay=0.0):
+    """Deliver events in order, `delay` seconds apart, yielding (event, status, body) for each."""
+    for i, event in enumerate(events):
+        if i and delay:
+            time.sleep(delay)
+        status, body = deliver(url, event, secret)
+        yield event, status, body
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("events", help="JSON Lines file with one Notion event per line")
+    parser.add_argument("--url", default=DEFAULT_URL, help="webhook endpoint of the app")
+    parser.add_argument("--secret", default=os.getenv("NOTION_WEBHOOK_SECRET"), help="signing secret (default: NOTION_WEBHOOK_SECRET)")
+    parser.add_argument("--delay", type=float, default=0, help="seconds between deliveries")
+    args = parser.parse_args(argv)
+
+    with open(args.events) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    failed = 0
+    for event, status, body in replay(args.url, events, args.secret, args.delay):
+        failed += status >= 300
+        print(f"{status} {event.get('type')} {(event.get('entity') or {}).get('id')} {body}")
+    if failed:
+        raise SystemExit(f"{failed} of {len(events)} events were not accepted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import os
+import threading
+from functools import lru_cache
+from dotenv import load_dotenv
+
+_lock = threading.Lock()
+_loaded = False
+
+
+def load():
+    """Load .env into the environment, once per process. Variables that are already set win."""
+    global _loaded
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                load_dotenv()
+                _loaded = True
+
+
+def get(name, default=None):
+    """Return a setting from the environment (after .env is loaded), or default."""
+    load()
+    return os.getenv(name, default)
+
+
+def get_bool(name, default="false"):
+    return get(name, default).strip().lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=None)
+def require(name):
+    """Return a required setting, raising RuntimeError if it is missing. Checked on first use, not at import."""
+    value = get(name)
+    if not value:
+        raise RuntimeError(f"{name} is not set in .env!")
+    return value
+
+
+def missing(*names):
+    """Return which of the required settings `names` are not set."""
+    return [name for name in names if not get(name)]
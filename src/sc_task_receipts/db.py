@@ -1,68 +1,90 @@
-import os
 import sqlite3
 import pathlib
-from dotenv import load_dotenv
-
-load_dotenv()
+import threading
+from sc_task_receipts import config
 
 PROJECT_ROOT = pathlib.Path(__file__).resolve().parents[2]
 
-_env_db = os.getenv('DB_PATH')
+_env_db = config.get('DB_PATH')
 if _env_db:
     DB_PATH = pathlib.Path(_env_db).expanduser()
 else:
     DB_PATH = PROJECT_ROOT / "data" / "counters.sqlite3"
 
 RECEIPT_COUNTER_NAME = "last_receipt_number"
-RECEIPT_NUMBER_RESET_AT = int(os.getenv('RECEIPT_NUMBER_RESET_AT', '99'))
-
-
-def _ensure_db():
-    """Create DB file and counters table if missing."""
-    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS counters (
-                name TEXT PRIMARY KEY,
-                last INTEGER NOT NULL
-            )
-        """)
-        conn.commit()
-    finally:
-        conn.close()
-
-
-def peek_next_receipt_number(max_val=RECEIPT_NUMBER_RESET_AT):
-    """Return next receipt number in range 1..max_val without committing it."""
-    _ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT last FROM counters WHERE name=?", (RECEIPT_COUNTER_NAME,))
-        row = cur.fetchone()
-        last = int(row[0]) if row and row[0] is not None else 0
-        next_num = (last % max_val) + 1
-        return next_num
-    finally:
-        conn.close()
-
-
-def commit_receipt_number(number):
-    """Atomically save provided receipt number as last used."""
-    _ensure_db()
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        cur = conn.cursor()
-        # Upsert pattern
-        cur.execute(
+RECEIPT_NUMBER_RESET_AT = int(config.get('RECEIPT_NUMBER_RESET_AT', '99'))
+
+
+class ReceiptCounter:
+    """Receipt number counter kept on one long-lived SQLite connection (WAL mode).
+
+    Numbers are handed out by reserve(), which reads and advances the counter in a single
+    write transaction, so concurrent prints (threads or processes) never get the same number.
+    """
+
+    def __init__(self, path=DB_PATH, name=RECEIPT_COUNTER_NAME):
+        self.path = path
+        self.name = name
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    last INTEGER NOT NULL
+                )
+            """)
+            self._conn = conn
+        return self._conn
+
+    def _last(self, conn):
+        row = conn.execute("SELECT last FROM counters WHERE name=?", (self.name,)).fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
+
+    def _store(self, conn, number):
+        conn.execute(
             "INSERT INTO counters(name, last) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET last=excluded.last",
-            (RECEIPT_COUNTER_NAME, int(number)),
+            (self.name, int(number)),
         )
-        conn.commit()
-        return True
-    except Exception as e:
-        print("Failed to commit receipt number:", e)
-        return False
-    finally:
-        conn.close()
+
+    def reserve(self, n=1, max_val=RECEIPT_NUMBER_RESET_AT):
+        """Take the next n numbers in range 1..max_val, wrapping after max_val, and return them in order."""
+        if n < 1:
+            return []
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                last = self._last(conn)
+                numbers = [((last + i) % max_val) + 1 for i in range(n)]
+                self._store(conn, numbers[-1])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return numbers
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_counter = ReceiptCounter()
+
+
+def reserve_receipt_numbers(n=1, max_val=RECEIPT_NUMBER_RESET_AT):
+    """Atomically reserve the next n receipt numbers (1..max_val, wrapping) and return them."""
+    return _counter.reserve(n, max_val)
+
+
+def close_counter():
+    """Close the counter's database connection; it is reopened on next use."""
+    _counter.close()
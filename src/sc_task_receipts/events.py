@@ -0,0 +1,126 @@
+import json
+import asyncio
+from sc_task_receipts import config
+from sc_task_receipts.notion_api import get_tasks_to_print, get_task_details, pop_changed_task_ids
+
+# Seconds between change checks while someone is subscribed (one check serves every subscriber)
+EVENTS_INTERVAL = float(config.get("EVENTS_INTERVAL", "2"))
+# Seconds between keep-alive comments on idle streams
+EVENTS_KEEPALIVE = 15
+EVENTS_QUEUE_SIZE = 100
+
+_subscribers = set()
+_snapshot = None
+_detector_task = None
+_changed = asyncio.Event()
+
+
+def _format(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def publish(event, data):
+    """Queue an event for every subscriber. Slow subscribers drop events instead of blocking others."""
+    message = _format(event, data)
+    for queue in list(_subscribers):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            pass
+
+
+def notify_changed():
+    """Ask the detector to check for changes now, e.g. right after a write made through the app."""
+    _changed.set()
+
+
+async def _publish_task_state(task_id, printed_event="task_printed"):
+    """Publish what became of a task that isn't (or is no longer) in the task list: done, removed or printed."""
+    try:
+        details = await get_task_details(task_id)
+    except Exception:
+        details = None
+    if details and details.done:
+        publish("task_done", {"task": details.to_dict()})
+    elif details and details.printed:
+        publish(printed_event, {"task": details.to_dict()})
+    else:
+        publish("task_removed", {"task": details.to_dict() if details else {"id": task_id}})
+
+
+async def _detect_changes():
+    """Diff the current task list against the last snapshot and publish what changed.
+
+    Tasks outside the list (printed ones, typically open on a task page) are covered by the ids
+    the Notion layer reports as changed, whether by a sync, a write through the app or a webhook.
+    """
+    global _snapshot
+    changed_ids = pop_changed_task_ids()
+    tasks = await get_tasks_to_print()
+    tasks = [t.to_dict() for t in tasks]
+    current = {t["id"]: t for t in tasks}
+    previous = _snapshot
+    _snapshot = current
+    if previous is None:
+        publish("tasks", {"data": tasks})
+        return
+
+    changed = False
+    for task_id, task in current.items():
+        if task_id not in previous:
+            publish("task_added", {"task": task})
+            changed = True
+        elif task != previous[task_id]:
+            publish("task_updated", {"task": task})
+            changed = True
+
+    for task_id in previous.keys() - current.keys():
+        # the task left the list: find out whether it was printed, done or removed
+        await _publish_task_state(task_id)
+        changed = True
+
+    for task_id in changed_ids - previous.keys() - current.keys():
+        # changed outside the list, e.g. a printed task edited in Notion
+        await _publish_task_state(task_id, printed_event="task_updated")
+
+    if changed:
+        publish("tasks", {"data": tasks})
+
+
+async def _detector_loop():
+    global _detector_task, _snapshot
+    try:
+        while _subscribers:
+            _changed.clear()
+            try:
+                await _detect_changes()
+            except Exception as e:
+                print("❌ Change detection failed:", e)
+            try:
+                await asyncio.wait_for(_changed.wait(), timeout=EVENTS_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # nobody is listening: forget the snapshot so the next subscriber starts fresh
+        _detector_task = None
+        _snapshot = None
+
+
+async def stream():
+    """Yield server-sent events for one subscriber until the client goes away."""
+    global _detector_task
+    queue = asyncio.Queue(maxsize=EVENTS_QUEUE_SIZE)
+    _subscribers.add(queue)
+    if _snapshot is not None:
+        queue.put_nowait(_format("tasks", {"data": list(_snapshot.values())}))
+    if _detector_task is None:
+        _detector_task = asyncio.get_running_loop().create_task(_detector_loop())
+    try:
+        yield f"retry: {int(EVENTS_INTERVAL * 1000)}\n\n"
+        while True:
+            try:
+                yield await asyncio.wait_for(queue.get(), timeout=EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        _subscribers.discard(queue)
@@ -0,0 +1,476 @@
+import os
+import time
+import uuid
+import queue
+import asyncio
+import sqlite3
+import threading
+from sc_task_receipts import config, events
+from sc_task_receipts.db import DB_PATH, reserve_receipt_numbers
+from sc_task_receipts.notion_api import get_many_task_details, iter_todo_summary_to_print, mark_task_as_printed
+from sc_task_receipts.printing import (
+    PRINTER_PROBE_INTERVAL, NoPrinterAvailable, PrinterUnavailable, print_task_receipt, print_todo_summary_batches,
+    close_printer_connection, pool_size, probe_printers,
+)
+
+JOB_MAX_ATTEMPTS = int(config.get("JOB_MAX_ATTEMPTS", "3"))
+# Seconds a job waits for a printer to come back before its remaining tasks are failed
+JOB_MAX_WAIT = float(config.get("JOB_MAX_WAIT", "3600"))
+
+# Job kinds
+PRINT_ALL = "print_all"      # tasks already printed by the time the worker reaches them are skipped
+PRINT_TASK = "print_task"    # explicit (re)print of a single task
+SUMMARY = "summary"
+
+# Per-task states. A task only moves to "printing" right before its receipt is sent, so a task found in
+# that state after a restart may already be on paper and is failed instead of being printed twice.
+PENDING, PRINTING, PRINTED, DONE, FAILED, SKIPPED = "pending", "printing", "printed", "done", "failed", "skipped"
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    """Open a connection to the jobs DB, creating the tables on first use."""
+    global _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                _ensure_tables()
+                _initialized = True
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _ensure_tables():
+    """Create job queue tables if missing. Lives in the same DB file as the counters."""
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                worker INTEGER
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_tasks (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                task_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                receipt_number INTEGER,
+                PRIMARY KEY (job_id, position)
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(job_tasks)")}
+        if "receipt_number" not in columns:
+            conn.execute("ALTER TABLE job_tasks ADD COLUMN receipt_number INTEGER")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "worker" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_job(kind, task_ids=()):
+    """Persist a new queued job and return its id."""
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs(id, kind, status, created_at) VALUES(?, ?, 'queued', ?)",
+            (job_id, kind, now),
+        )
+        conn.executemany(
+            "INSERT INTO job_tasks(job_id, position, task_id, status, updated_at) VALUES(?, ?, ?, ?, ?)",
+            [(job_id, i, task_id, PENDING, now) for i, task_id in enumerate(task_ids)],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    _notify()
+    return job_id
+
+
+def get_job(job_id):
+    """Return a job with its per-task progress, or None if unknown."""
+    conn = _connect()
+    try:
+        job = conn.execute("SELECT * FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if not job:
+            return None
+        tasks = conn.execute(
+            "SELECT task_id, status, attempts, error FROM job_tasks WHERE job_id=? ORDER BY position",
+            (job_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+
+    tasks = [dict(t) for t in tasks]
+    counts = {}
+    for t in tasks:
+        counts[t["status"]] = counts.get(t["status"], 0) + 1
+    out = dict(job)
+    out["tasks"] = tasks
+    out["progress"] = {
+        "total": len(tasks),
+        "printed": counts.get(DONE, 0),
+        "failed": counts.get(FAILED, 0),
+        "skipped": counts.get(SKIPPED, 0),
+        "remaining": counts.get(PENDING, 0) + counts.get(PRINTING, 0) + counts.get(PRINTED, 0),
+    }
+    return out
+
+
+def _worker_alive(pid):
+    """Whether the process that claimed a job is still running. Workers share one SQLite file, so they
+    all run on this host and a process id identifies one.
+    """
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim_next_job():
+    """Claim the oldest job no live worker owns and return it, or None if there is none.
+
+    Several worker processes (uvicorn --workers N) drain the same queue, so a job is claimed with a
+    conditional UPDATE: only the worker whose UPDATE changed the row prints it. A running or waiting
+    job is only taken over once the process that claimed it is gone, and is made safe to resume first.
+    """
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE status IN ('queued', 'running', 'waiting') ORDER BY created_at"
+        ).fetchall()
+        for row in rows:
+            if row["status"] != "queued" and _worker_alive(row["worker"]):
+                continue
+            claimed = conn.execute(
+                "UPDATE jobs SET status='running', worker=?, started_at=COALESCE(started_at, ?) "
+                "WHERE id=? AND status=? AND worker IS ?",
+                (os.getpid(), time.time(), row["id"], row["status"], row["worker"]),
+            ).rowcount
+            conn.commit()
+            if not claimed:
+                # another worker got there first
+                continue
+            if row["status"] == "queued" or _recover_interrupted(conn, dict(row)):
+                return dict(conn.execute("SELECT * FROM jobs WHERE id=?", (row["id"],)).fetchone())
+        return None
+    finally:
+        conn.close()
+
+
+def _job_tasks(job_id, statuses):
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            f"SELECT * FROM job_tasks WHERE job_id=? AND status IN ({', '.join('?' for _ in statuses)}) ORDER BY position",
+            (job_id, *statuses),
+        ).fetchall()
+        return [dict(r) for r in rows]
+    finally:
+        conn.close()
+
+
+def _set_job(job_id, **fields):
+    conn = _connect()
+    try:
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+            (*fields.values(), job_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _reserve_numbers(job_id, positions):
+    """Reserve one block of receipt numbers for job tasks and keep them, so a retry prints under the same number."""
+    numbers = reserve_receipt_numbers(len(positions))
+    conn = _connect()
+    try:
+        conn.executemany(
+            "UPDATE job_tasks SET receipt_number=? WHERE job_id=? AND position=?",
+            [(number, job_id, position) for number, position in zip(numbers, positions)],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return numbers
+
+
+def _set_task(job_id, position, status, error=None, attempt=False):
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE job_tasks SET status=?, error=?, attempts=attempts+?, updated_at=? WHERE job_id=? AND position=?",
+            (status, error, 1 if attempt else 0, time.time(), job_id, position),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _recover_interrupted(conn, job):
+    """Make a job left over by a worker that stopped mid-job safe to resume. Returns False if it can't be.
+
+    Tasks caught mid-print are failed rather than retried, since their receipt may already be out.
+    Summary jobs have no per-task state, so an interrupted one is failed for the same reason.
+    """
+    now = time.time()
+    error = "Interrupted while printing, not retried to avoid a double print"
+    conn.execute(
+        "UPDATE job_tasks SET status=?, error=?, updated_at=? WHERE job_id=? AND status=?",
+        (FAILED, error, now, job["id"], PRINTING),
+    )
+    resumable = not (job["kind"] == SUMMARY and job["status"] == "running")
+    if not resumable:
+        conn.execute("UPDATE jobs SET status='failed', error=?, finished_at=? WHERE id=?", (error, now, job["id"]))
+    conn.commit()
+    return resumable
+
+
+async def _prepare_pass(job, pending):
+    """Read a pass's pending tasks, skip the ones a print-all no longer needs and number the rest.
+
+    Returns {position: task} for the tasks to print. Tasks that can't be read stay pending for the
+    next pass. Numbers are only reserved for tasks that will print, so skips leave no gaps, and they
+    are reserved as one block.
+    """
+    found = await get_many_task_details([jt["task_id"] for jt in pending])
+    ready = []
+    for jt in pending:
+        task = found[jt["task_id"]]
+        if isinstance(task, Exception):
+            await asyncio.to_thread(_set_task, job["id"], jt["position"], PENDING, str(task))
+        elif job["kind"] == PRINT_ALL and (task.printed or task.done):
+            await asyncio.to_thread(_set_task, job["id"], jt["position"], SKIPPED, "Already printed or done")
+        else:
+            ready.append((jt, task))
+    unnumbered = [jt for jt, _ in ready if jt["receipt_number"] is None]
+    if unnumbered:
+        numbers = await asyncio.to_thread(_reserve_numbers, job["id"], [jt["position"] for jt in unnumbered])
+        for jt, number in zip(unnumbered, numbers):
+            jt["receipt_number"] = number
+    return {jt["position"]: task for jt, task in ready}
+
+
+async def _print_task(job, jt, task):
+    """Print one job task. Returns False if it failed in a way that must not be retried."""
+    await asyncio.to_thread(_set_task, job["id"], jt["position"], PRINTING, attempt=True)
+    try:
+        await asyncio.to_thread(print_task_receipt, task.id, task.project, task.priority, task.title, task.planned_start, task.due_date, task.description, jt["receipt_number"])
+    except PrinterUnavailable:
+        # no printer took the receipt, so nothing was sent and the task is safe to retry
+        await asyncio.to_thread(_set_task, job["id"], jt["position"], PENDING)
+        raise
+    except Exception as e:
+        # sending may have started, so the receipt may be on paper: fail it rather than print it twice,
+        # and leave Printed in Notion as it is
+        error = f"Printing failed, not retried to avoid a double print: {e}"
+        await asyncio.to_thread(_set_task, job["id"], jt["position"], FAILED, error)
+        return False
+    await asyncio.to_thread(_set_task, job["id"], jt["position"], PRINTED)
+    return True
+
+
+async def _mark_printed(job, jt):
+    try:
+        await mark_task_as_printed(jt["task_id"])
+        await asyncio.to_thread(_set_task, job["id"], jt["position"], DONE)
+        events.notify_changed()
+    except Exception as e:
+        # the receipt is out; only the Notion update is retried
+        await asyncio.to_thread(_set_task, job["id"], jt["position"], PRINTED, str(e))
+
+
+async def _wait_for_printer(job, reason):
+    """Park the job as "waiting" and probe the printers until one is back.
+    Raises NoPrinterAvailable if none comes back within JOB_MAX_WAIT.
+    """
+    await asyncio.to_thread(_set_job, job["id"], status="waiting", error=reason)
+    deadline = time.monotonic() + JOB_MAX_WAIT
+    while not await asyncio.to_thread(probe_printers):
+        if time.monotonic() >= deadline:
+            raise NoPrinterAvailable(reason)
+        await asyncio.sleep(PRINTER_PROBE_INTERVAL)
+    await asyncio.to_thread(_set_job, job["id"], status="running", error=None)
+
+
+async def _run_tasks_job(job):
+    # Each pass tries every unfinished task once, so failed tasks are retried after
+    # the rest of the batch instead of stalling it. A pass cut short because no printer
+    # was available doesn't count: the job waits for a printer and tries again.
+    passes = 0
+    while passes < JOB_MAX_ATTEMPTS:
+        todo = await asyncio.to_thread(_job_tasks, job["id"], (PENDING, PRINTED))
+        if not todo:
+            break
+        marks = []
+        # one receipt in flight per printer; the pool sends each to the least busy (or the project's) printer
+        slots = asyncio.Semaphore(pool_size())
+        deferred = None
+        ready = await _prepare_pass(job, [jt for jt in todo if jt["status"] == PENDING])
+
+        async def run(jt):
+            nonlocal deferred
+            if jt["status"] == PENDING:
+                if jt["position"] not in ready:
+                    return
+                async with slots:
+                    if deferred:
+                        return
+                    try:
+                        if not await _print_task(job, jt, ready[jt["position"]]):
+                            return
+                    except NoPrinterAvailable as e:
+                        deferred = str(e)
+                        await asyncio.to_thread(_set_task, job["id"], jt["position"], PENDING, deferred)
+                        return
+                    except Exception as e:
+                        # raised before anything was sent
+                        await asyncio.to_thread(_set_task, job["id"], jt["position"], PENDING, str(e))
+                        return
+            # Notion is updated through the rate-limited write pipeline while the next receipt prints
+            marks.append(asyncio.create_task(_mark_printed(job, jt)))
+
+        await asyncio.gather(*(run(jt) for jt in todo))
+        await asyncio.gather(*marks)
+        if deferred:
+            try:
+                await _wait_for_printer(job, deferred)
+            except NoPrinterAvailable:
+                break
+        else:
+            passes += 1
+
+    return await asyncio.to_thread(_finish_tasks, job["id"])
+
+
+def _finish_tasks(job_id):
+    """Fail the tasks a job gave up on and return the job's error, if any task failed."""
+    for jt in _job_tasks(job_id, (PENDING,)):
+        _set_task(job_id, jt["position"], FAILED, jt["error"])
+    for jt in _job_tasks(job_id, (PRINTED,)):
+        _set_task(job_id, jt["position"], FAILED, f"Printed, but marking it in Notion failed: {jt['error']}")
+    failed = _job_tasks(job_id, (FAILED,))
+    return f"{len(failed)} {'tasks' if len(failed) != 1 else 'task'} failed" if failed else None
+
+
+def _drain(batches):
+    """Yield task batches put on a queue by the event loop until None; re-raise a queued exception."""
+    while (batch := batches.get()) is not None:
+        if isinstance(batch, Exception):
+            raise batch
+        yield batch
+
+
+async def _stream_summary():
+    """Print the todo summary while it is being fetched: each batch of tasks goes to the printing
+    thread as soon as it arrives, so the first entries print before the last Notion page is in.
+    """
+    batches = queue.Queue()
+    printing = asyncio.ensure_future(asyncio.to_thread(print_todo_summary_batches, _drain(batches)))
+    try:
+        async for batch in iter_todo_summary_to_print():
+            if printing.done():
+                # nothing will read the rest, e.g. no printer was available
+                break
+            batches.put([t.to_dict() for t in batch])
+    except Exception as e:
+        batches.put(e)
+    finally:
+        batches.put(None)
+    await printing
+
+
+async def _run_summary_job(job):
+    while True:
+        try:
+            await _stream_summary()
+            return
+        except NoPrinterAvailable as e:
+            await _wait_for_printer(job, str(e))
+
+
+async def _run_job(job):
+    try:
+        if job["kind"] == SUMMARY:
+            error = await _run_summary_job(job)
+        else:
+            error = await _run_tasks_job(job)
+    except Exception as e:
+        error = str(e)
+    await asyncio.to_thread(
+        _set_job, job["id"], status="failed" if error else "done", error=error, finished_at=time.time()
+    )
+
+
+_wakeup = asyncio.Event()
+_worker_task = None
+
+
+def _notify():
+    # create_job may be called from a worker thread; the event belongs to the loop
+    loop = _worker_task.get_loop() if _worker_task is not None else None
+    if loop is not None and loop.is_running():
+        loop.call_soon_threadsafe(_wakeup.set)
+
+
+async def _worker_loop():
+    while True:
+        job = await asyncio.to_thread(_claim_next_job)
+        if job is None:
+            _wakeup.clear()
+            # re-check so a job created between the query and clear() is not missed
+            job = await asyncio.to_thread(_claim_next_job)
+            if job is None:
+                # queue drained: let go of the printer until the next job arrives
+                close_printer_connection()
+                await _wakeup.wait()
+                continue
+        try:
+            await _run_job(job)
+        except Exception as e:
+            print("❌ Print job failed:", e)
+            await asyncio.sleep(1)
+
+
+def start_worker():
+    """Start draining the queue on the running event loop."""
+    global _worker_task
+    if _worker_task is not None:
+        return _worker_task
+    _worker_task = asyncio.get_running_loop().create_task(_worker_loop())
+    return _worker_task
+
+
+def stop_worker():
+    global _worker_task
+    if _worker_task is not None:
+        _worker_task.cancel()
+        _worker_task = None
@@ -1,104 +1,268 @@
-import os
-from dotenv import load_dotenv
+import json
+import asyncio
+from typing import Literal
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, APIRouter, Request, HTTPException
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, StreamingResponse, Response, JSONResponse
 from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
 from pathlib import Path
-from sc_task_receipts.notion_api import get_tasks_to_print, get_todo_summary_to_print, mark_task_as_printed, unmark_task_as_printed, mark_task_as_done, get_task_details, refresh_projects
-from sc_task_receipts.printing import print_task_receipt, print_todo_summary_receipt
-
-load_dotenv()
+from sc_task_receipts.notion_api import get_tasks_to_print, unmark_task_as_printed, mark_task_as_done, get_task_details, get_many_task_details, get_tasks_version, get_single_flight_stats, get_details_cache_stats, get_write_pipeline_stats, refresh_projects, start_background_sync, stop_background_sync, close_write_pipeline, prewarm, projects_loaded, get_sync_status
+from sc_task_receipts import config, jobs, events, metrics, rendering, webhooks
+from sc_task_receipts.responses import COMPRESS_MIN_SIZE, CachedBody, CompressionMiddleware, HashedStaticFiles, conditional_response
+from sc_task_receipts.printing import printers_status, probe_printers
+from sc_task_receipts.db import close_counter
 
 print("Starting SC Task Receipts application...")
-print("Base URL:", os.getenv("BASE_URL", "http://localhost:8000"))
+print("Base URL:", config.get("BASE_URL", "http://localhost:8000"))
+
+REQUIRED_SETTINGS = ("NOTION_TOKEN", "NOTION_TASKS_ID", "NOTION_PROJECTS_ID")
+# Largest number of task ids accepted by POST /api/v1/tasks/bulk
+BULK_MAX_TASKS = int(config.get("BULK_MAX_TASKS", "100"))
 
 PACKAGE_DIR = Path(__file__).resolve().parent
 STATIC_DIR = str(PACKAGE_DIR / "static")
 TEMPLATES_DIR = str(PACKAGE_DIR / "templates")
 
-app = FastAPI()
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+_prewarm_task = None
+
+async def _prewarm():
+  # load projects and import the ESC/POS stack without holding up startup
+  await asyncio.gather(prewarm(), asyncio.to_thread(rendering.prewarm))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  global _prewarm_task
+  _prewarm_task = asyncio.create_task(_prewarm())
+  # keep the local task mirror in sync with Notion while the app runs
+  start_background_sync()
+  # drain the print job queue, resuming jobs left over from a previous run
+  jobs.start_worker()
+  yield
+  _prewarm_task.cancel()
+  jobs.stop_worker()
+  stop_background_sync()
+  close_write_pipeline()
+  close_counter()
+
+app = FastAPI(lifespan=lifespan)
+# compresses whatever isn't served pre-compressed from the body cache below (skips SSE streams)
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=6)
+app.add_middleware(metrics.MetricsMiddleware)
+static_files = HashedStaticFiles(STATIC_DIR)
+app.mount("/static", static_files, name="static")
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
 
+def static_url(request, path):
+  """Content-hashed URL of a static file, cacheable forever by the browser."""
+  return f"{request.scope.get('root_path', '')}/static/{static_files.url(path)}"
+
+templates.env.globals["static_url"] = static_url
+
 api_v1_router = APIRouter(prefix="/api/v1")
 
+# cache key -> (data version, CachedBody)
+_body_cache = {}
+
+async def _conditional(request: Request, cache_key, version, build, media_type):
+  """Return the bytes from build() with a strong ETag, compressed if the client accepts it, or 304
+  if the client's copy matches. While `version` is unchanged the body, its hash and its compressed
+  variants are reused without calling build().
+  """
+  cached = _body_cache.get(cache_key)
+  if version is None or not cached or cached[0] != version:
+    cached = (version, CachedBody(await build(), media_type))
+    if version is not None:
+      if len(_body_cache) >= 1024:
+        _body_cache.clear()
+      _body_cache[cache_key] = cached
+  return conditional_response(request, cached[1])
+
+async def _conditional_json(request: Request, cache_key, version, build):
+  """Return build()'s payload as JSON; see _conditional."""
+  async def serialize():
+    payload = await build()
+    return json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+  return await _conditional(request, cache_key, version, serialize, "application/json")
+
+async def _conditional_html(request: Request, cache_key, version, template, build):
+  """Render template with build()'s context; cached per `version` like _conditional_json."""
+  async def render():
+    context = await build()
+    return templates.get_template(template).render(request=request, **context).encode("utf-8")
+  # the page links to static files under root_path, so pages differ per mount point
+  key = (cache_key, request.scope.get("root_path", ""))
+  return await _conditional(request, key, version, render, "text/html; charset=utf-8")
+
 @api_v1_router.get("/tasks")
-def get_tasks():
-  tasks = get_tasks_to_print()
-  out = []
-  for t in tasks:
-    try:
-      out.append(t.__dict__)
-    except Exception:
-      out.append(dict(t))
-  return {"message": f"Tasks have been retrieved", "data": out}
-
-@api_v1_router.post("/tasks/print")
-def print_tasks():
-  tasks = get_tasks_to_print()
-  successes = 0
-  failures = []
-  for task in tasks:
-    try:
-      print_task_receipt(task["id"], task["project"], task["priority"], task["title"], task["planned_start"], task["due_date"], task["description"])
-      mark_task_as_printed(task["id"])
-      successes += 1
-    except Exception as e:
-      failures.append({"id": task.get("id"), "error": str(e)})
-
-  msg = f"{successes} {'tasks' if successes != 1 else 'task'} printed"
-  if failures:
-    raise HTTPException(status_code=500, detail={"message": msg + f", {len(failures)} failed", "failures": failures, "successes": successes})
-  return {"message": msg}
-
-@api_v1_router.post("/tasks/summary/print")
-def print_todo_summary():
-  tasks = get_todo_summary_to_print()
-  try:
-    print_todo_summary_receipt(tasks)
-    return {"message": "ToDo summary printed"}
-  except Exception as e:
-    raise HTTPException(status_code=500, detail={"message": "ToDo summary failed to print", "error": str(e)})
+async def get_tasks(request: Request):
+  async def build():
+    tasks = await get_tasks_to_print()
+    return {"message": f"Tasks have been retrieved", "data": [t.to_dict() for t in tasks]}
+  return await _conditional_json(request, "tasks", await get_tasks_version(), build)
+
+@api_v1_router.post("/tasks/print", status_code=202)
+async def print_tasks():
+  tasks = await get_tasks_to_print()
+  job_id = await asyncio.to_thread(jobs.create_job, jobs.PRINT_ALL, [t.id for t in tasks])
+  return {"message": f"{len(tasks)} {'tasks' if len(tasks) != 1 else 'task'} queued for printing", "job_id": job_id}
+
+@api_v1_router.post("/tasks/summary/print", status_code=202)
+async def print_todo_summary():
+  job_id = await asyncio.to_thread(jobs.create_job, jobs.SUMMARY)
+  return {"message": "ToDo summary queued for printing", "job_id": job_id}
+
+@api_v1_router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+  job = await asyncio.to_thread(jobs.get_job, job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="Job not found")
+  return {"message": "Job status has been retrieved", "data": job}
+
+@api_v1_router.get("/events")
+async def stream_events():
+  # one change detector feeds every open dashboard and task page
+  return StreamingResponse(
+    events.stream(),
+    media_type="text/event-stream",
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+  )
+
+class BulkTaskAction(BaseModel):
+  action: Literal["print", "unprint", "done"]
+  ids: list[str]
+
+_BULK_WRITES = {"unprint": unmark_task_as_printed, "done": mark_task_as_done}
+
+@api_v1_router.post("/tasks/bulk")
+async def bulk_task_action(body: BulkTaskAction):
+  """Print, unprint or finish many tasks in one call and report the outcome per id.
+
+  print: the tasks are looked up together, then queued as one print job (reported as "queued").
+  unprint/done: the Notion updates go through the shared write pipeline, which runs a few at once.
+  """
+  ids = list(dict.fromkeys(body.ids))
+  if len(ids) > BULK_MAX_TASKS:
+    raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_TASKS} tasks per request")
+
+  if body.action == "print":
+    found = await get_many_task_details(ids)
+    queued = [id for id in ids if not isinstance(found[id], Exception)]
+    job_id = await asyncio.to_thread(jobs.create_job, jobs.PRINT_TASK, queued) if queued else None
+    results = [{"id": id, "status": "queued"} if id in queued else {"id": id, "status": "failed", "error": str(found[id])} for id in ids]
+    message = f"{len(queued)} {'tasks' if len(queued) != 1 else 'task'} queued for printing"
+    return JSONResponse({"message": message, "job_id": job_id, "data": results}, status_code=202)
+
+  outcomes = await asyncio.gather(*(_BULK_WRITES[body.action](id) for id in ids), return_exceptions=True)
+  if any(not isinstance(o, Exception) for o in outcomes):
+    events.notify_changed()
+  results = [{"id": id, "status": "failed", "error": str(o)} if isinstance(o, Exception) else {"id": id, "status": "ok"} for id, o in zip(ids, outcomes)]
+  ok = sum(r["status"] == "ok" for r in results)
+  verb = "unmarked as printed" if body.action == "unprint" else "marked as done"
+  return {"message": f"{ok} of {len(ids)} {'tasks' if len(ids) != 1 else 'task'} {verb}", "data": results}
 
 @api_v1_router.get("/tasks/{task_id}")
-def get_task(task_id: str):
-  task_details = get_task_details(task_id)
-  return {"message": "Task data has been retrieved", "data": task_details}
+async def get_task(request: Request, task_id: str):
+  async def build():
+    task_details = await get_task_details(task_id)
+    return {"message": "Task data has been retrieved", "data": task_details.to_dict()}
+  return await _conditional_json(request, ("task", task_id), await get_tasks_version(), build)
 
-@api_v1_router.post("/tasks/{task_id}/print")
-def print_task(task_id: str):
-  task = get_task_details(task_id)
-  try:
-    print_task_receipt(task["id"], task["project"], task["priority"], task["title"], task["planned_start"], task["due_date"], task["description"])
-    mark_task_as_printed(task["id"])
-    return {"message": "Task printed"}
-  except Exception:
-    raise HTTPException(status_code=500, detail="Failed to print")
+@api_v1_router.post("/tasks/{task_id}/print", status_code=202)
+async def print_task(task_id: str):
+  job_id = await asyncio.to_thread(jobs.create_job, jobs.PRINT_TASK, [task_id])
+  return {"message": "Task queued for printing", "job_id": job_id}
 
 @api_v1_router.post("/tasks/{task_id}/unprint")
-def unprint_task(task_id: str):
-  unmark_task_as_printed(task_id)
+async def unprint_task(task_id: str):
+  await unmark_task_as_printed(task_id)
+  events.notify_changed()
   return {"message": "Task unmarked as printed"}
 
 @api_v1_router.post("/tasks/{task_id}/done")
-def task_done(task_id: str):
-  mark_task_as_done(task_id)
+async def task_done(task_id: str):
+  await mark_task_as_done(task_id)
+  events.notify_changed()
   return {"message": "Task marked as done"}
 
 @api_v1_router.post('/projects/refresh')
-def api_refresh_projects():
-    refresh_projects()
-    return {"message": "Projects refreshed"}
+async def api_refresh_projects():
+    count = await refresh_projects()
+    events.notify_changed()
+    return {"message": f"{count} projects refreshed"}
+
+@api_v1_router.post("/webhooks/notion")
+async def notion_webhook(request: Request):
+  body = await request.body()
+  try:
+    event = json.loads(body)
+  except ValueError:
+    event = None
+  if not isinstance(event, dict):
+    raise HTTPException(status_code=400, detail="Invalid event")
+  if "verification_token" in event:
+    # one-time handshake when the subscription is created; the token is also the signing secret
+    print("🔑 Notion webhook verification token (set it as NOTION_WEBHOOK_SECRET):", event["verification_token"])
+    return {"message": "Verification token received"}
+  if not webhooks.verify(body, request.headers.get("X-Notion-Signature")):
+    raise HTTPException(status_code=401, detail="Invalid signature")
+  result = await webhooks.handle(event)
+  if result in ("updated", "removed"):
+    events.notify_changed()
+  return {"message": f"Event {result}"}
+
+@api_v1_router.get("/printers")
+async def get_printers():
+  return {"message": "Printers have been retrieved", "data": printers_status()}
+
+@api_v1_router.post("/printers/probe")
+async def api_probe_printers():
+  await asyncio.to_thread(probe_printers, True)
+  return {"message": "Printers have been probed", "data": printers_status()}
+
+@api_v1_router.get("/stats")
+async def get_stats():
+  return {"message": "Stats have been retrieved", "data": {"single_flight": get_single_flight_stats(), "task_details_cache": get_details_cache_stats(), "write_pipeline": get_write_pipeline_stats()}}
 
 app.include_router(api_v1_router)
 
+@app.get("/healthz")
+async def healthz():
+  """Readiness: settings present and the projects map loaded. 503 until then."""
+  missing = config.missing(*REQUIRED_SETTINGS)
+  if not config.get("PRINTERS"):
+    missing += config.missing("PRINTER_IP")
+  if projects_loaded():
+    projects = "ok"
+  elif _prewarm_task is not None and _prewarm_task.done() and not _prewarm_task.cancelled() and _prewarm_task.exception():
+    projects = f"failed: {_prewarm_task.exception()}"
+  else:
+    projects = "loading"
+  ready = not missing and projects == "ok"
+  checks = {
+    "config": f"missing {', '.join(missing)}" if missing else "ok",
+    "projects": projects,
+    "task_mirror": get_sync_status(),
+  }
+  if not missing:
+    # informational: print jobs wait for a printer instead of failing, so this doesn't affect readiness
+    printers = printers_status()
+    checks["printers"] = f"{sum(p['state'] != 'open' for p in printers)} of {len(printers)} available"
+  return JSONResponse({"status": "ok" if ready else "unavailable", "checks": checks}, status_code=200 if ready else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+  body, content_type = metrics.render()
+  return Response(content=body, media_type=content_type)
+
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request):
-  tasks = get_tasks_to_print()
-  return templates.TemplateResponse("index.html", {"request": request, "tasks": tasks})
+async def index(request: Request):
+  async def build():
+    return {"tasks": await get_tasks_to_print()}
+  return await _conditional_html(request, "index", await get_tasks_version(), "index.html", build)
 
 @app.get("/tasks/{task_id}", response_class=HTMLResponse)
-def task_detail(request: Request, task_id: str):
-  task = get_task_details(task_id)
-  return templates.TemplateResponse("task_details.html", {"request": request, "task": task})
\ No newline at end of file
+async def task_detail(request: Request, task_id: str):
+  async def build():
+    return {"task": await get_task_details(task_id)}
+  return await _conditional_html(request, ("task_page", task_id), await get_tasks_version(), "task_details.html", build)
\ No newline at end of file
@@ -0,0 +1,95 @@
+import time
+from prometheus_client import Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Everything here is a plain in-process counter or bucket increment; the text format is only
+# rendered when /metrics is scraped.
+
+NOTION_REQUEST_SECONDS = Histogram(
+    "notion_request_seconds",
+    "Latency of Notion API calls",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 30),
+)
+PRINTER_SECONDS = Histogram(
+    "printer_seconds",
+    "Printer latency: connect, probe (status request), transmit (one sendall) and receipt (render through the cut being sent)",
+    ["operation"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+RECEIPT_BYTES = Histogram(
+    "receipt_bytes",
+    "Size of the ESC/POS data sent per receipt",
+    ["kind"],
+    buckets=(512, 1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144),
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds",
+    "Time until the response starts, per route",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+PROJECTS_CACHE = Counter(
+    "projects_cache_lookups_total",
+    "Project names looked up in the projects cache",
+    ["result"],
+)
+PROJECTS_REFRESHES = Counter(
+    "projects_cache_refreshes_total",
+    "Full reloads of the projects map from Notion",
+)
+PRINT_FAILURES = Counter(
+    "print_failures_total",
+    "Receipts that could not be sent to the printer",
+    ["kind"],
+)
+
+WEBHOOK_EVENTS = Counter(
+    "notion_webhook_events_total",
+    "Notion webhook events received, by event type and what they changed locally",
+    ["type", "result"],
+)
+
+
+def render():
+    """Return (body, content type) for a scrape."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by its route template (not the raw path).
+    Streaming responses such as /api/v1/events are timed until their headers go out.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status):
+            nonlocal observed
+            observed = True
+            route = scope.get("route")
+            if route is not None:
+                path = route.path
+            elif scope.get("root_path"):
+                # served by a mount such as /static
+                path = scope["root_path"] + "/{path}"
+            else:
+                path = "unmatched"
+            HTTP_REQUEST_SECONDS.labels(scope["method"], path, str(status)).observe(time.perf_counter() - started)
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start" and not observed:
+                observe(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        except Exception:
+            if not observed:
+                observe(500)
+            raise
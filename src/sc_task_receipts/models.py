@@ -0,0 +1,85 @@
+from dataclasses import dataclass, field
+from datetime import date, datetime
+
+# Lower rank sorts first; unknown or missing priorities go last
+PRIORITY_RANK = {
+    "high": 0,
+    "medium": 1,
+    "low": 2,
+    "optional": 3,
+}
+
+
+def _parse_date(s):
+    """Return a date object for ISO date string s, or None if missing/invalid."""
+    if not s or s == "NONE":
+        return None
+    try:
+        # handle both date-only and datetime ISO strings
+        if 'T' in s:
+            return datetime.fromisoformat(s).date()
+        return date.fromisoformat(s)
+    except Exception:
+        return None
+
+
+@dataclass(slots=True)
+class Task:
+    """A task as shown on the dashboard, the task page and the receipts.
+
+    The sort key is computed once when the task is built: 1) due_date (earliest first, missing last),
+    2) priority (High->Medium->Low->Optional), 3) planned_start (earliest first, missing last), 4) title.
+    Tasks are shared between concurrent readers and caches, so treat them as read-only.
+    """
+
+    id: str
+    project: str = ""
+    priority: str = ""
+    title: str = ""
+    planned_start: str = ""
+    due_date: str = ""
+    description: str = ""
+    printed: bool = False
+    done: bool = False
+    sort_key: tuple = field(default=None, compare=False, repr=False)
+
+    def __post_init__(self):
+        if self.sort_key is None:
+            due = _parse_date(self.due_date)
+            planned = _parse_date(self.planned_start)
+            self.sort_key = (
+                due is None,
+                due or date.max,
+                PRIORITY_RANK.get(self.priority.strip().lower(), 4),
+                planned is None,
+                planned or date.max,
+                self.title.lower(),
+            )
+
+    @classmethod
+    def from_row(cls, row, project=""):
+        """Build a task from a task_mirror row (see notion_api._page_to_row) and its project name."""
+        return cls(
+            row["id"],
+            project or "",
+            row["priority"] or "",
+            row["title"] or "",
+            row["planned_start"] or "",
+            row["due_date"] or "",
+            row["description"] or "",
+            bool(row["printed"]),
+            bool(row["done"]),
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "project": self.project,
+            "priority": self.priority,
+            "title": self.title,
+            "planned_start": self.planned_start,
+            "due_date": self.due_date,
+            "description": self.description,
+            "printed": self.printed,
+            "done": self.done,
+        }
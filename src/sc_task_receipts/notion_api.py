@@ -1,315 +1,680 @@
-import os
-from dotenv import load_dotenv
-from notion_client import Client
-from datetime import date, datetime
+import time
+import asyncio
+from operator import attrgetter
+from collections import OrderedDict
+from notion_client import AsyncClient, APIErrorCode, APIResponseError
+from datetime import date, datetime, timedelta, timezone
+from sc_task_receipts import config, task_mirror
+from sc_task_receipts.models import Task
+from sc_task_receipts.metrics import NOTION_REQUEST_SECONDS, PROJECTS_CACHE, PROJECTS_REFRESHES
+from sc_task_receipts.write_pipeline import WritePipeline
 
-load_dotenv()
+# Seconds a mirrored task list may be old before a read triggers a foreground sync. 0 disables the mirror.
+TASK_MAX_STALENESS = float(config.get("TASK_MAX_STALENESS", "30"))
+TASK_SYNC_INTERVAL = float(config.get("TASK_SYNC_INTERVAL", "5"))
+TASK_FULL_SYNC_INTERVAL = float(config.get("TASK_FULL_SYNC_INTERVAL", "3600"))
+# Page updates are spread over a few workers but kept under Notion's ~3 requests/second limit
+NOTION_WRITE_RATE = float(config.get("NOTION_WRITE_RATE", "3"))
+NOTION_WRITE_WORKERS = int(config.get("NOTION_WRITE_WORKERS", "3"))
+# Seconds before the projects map is refreshed in the background
+PROJECTS_CACHE_TTL = float(config.get("PROJECTS_CACHE_TTL", "3600"))
+# Number of task detail results kept in memory
+TASK_DETAILS_CACHE_SIZE = int(config.get("TASK_DETAILS_CACHE_SIZE", "256"))
 
-NOTION_TOKEN = os.getenv("NOTION_TOKEN")
-NOTION_TASKS_ID = os.getenv("NOTION_TASKS_ID")
-NOTION_PROJECTS_ID = os.getenv("NOTION_PROJECTS_ID")
+# Point the client somewhere other than api.notion.com, e.g. the stand-in used by benchmarks/
+NOTION_BASE_URL = config.get("NOTION_BASE_URL")
 
-if not NOTION_TOKEN:
-    raise RuntimeError("NOTION_TOKEN is not set in .env!")
-  
-if not NOTION_TASKS_ID:
-    raise RuntimeError("NOTION_TASKS_ID is not set in .env!")
+_notion = None
 
-if not NOTION_PROJECTS_ID:
-    raise RuntimeError("NOTION_PROJECTS_ID is not set in .env!")
+def _client():
+  """Return the Notion client, creating it (and checking NOTION_TOKEN) on first use."""
+  global _notion
+  if _notion is None:
+    _notion = AsyncClient(auth=config.require("NOTION_TOKEN"), **({"base_url": NOTION_BASE_URL} if NOTION_BASE_URL else {}))
+  return _notion
 
-notion = Client(auth=NOTION_TOKEN)
+async def _timed(operation, call):
+  """Await a Notion API call, recording its latency under `operation`."""
+  with NOTION_REQUEST_SECONDS.labels(operation).time():
+    return await call
 
-_projects_cache = None
+_writes = WritePipeline(
+  lambda page_id, properties: _timed("update", _client().pages.update(page_id=page_id, properties=properties)),
+  rate=NOTION_WRITE_RATE,
+  workers=NOTION_WRITE_WORKERS,
+)
 
-def _invalidate_projects_cache():
-    """Helper to invalidate the in-memory projects cache."""
-    global _projects_cache
-    _projects_cache = None
-    #print("projects: cache invalidated")
+# key -> in-flight task shared by concurrent identical reads
+_in_flight = {}
+# operation -> {"calls": reads actually sent, "saved": reads that joined one already in flight}
+_single_flight_stats = {}
 
+async def _single_flight(key, fetch):
+  """Run fetch() once for all concurrent callers asking for the same key and share its result.
+  key[0] names the operation for the stats. Shared results must be treated as read-only.
+  """
+  stats = _single_flight_stats.setdefault(key[0], {"calls": 0, "saved": 0})
+  task = _in_flight.get(key)
+  if task is None:
+    stats["calls"] += 1
+    task = asyncio.ensure_future(fetch())
+    _in_flight[key] = task
+    task.add_done_callback(lambda t: _in_flight.pop(key, None) if _in_flight.get(key) is t else None)
+  else:
+    stats["saved"] += 1
+  # shield so one caller going away doesn't cancel the read for everyone else
+  return await asyncio.shield(task)
 
-def refresh_projects():
-    """Force-refresh the projects cache from Notion and return how many projects were loaded.
-    This invalidates the cache and then calls get_projects_map() which will re-populate it.
-    """
-    _invalidate_projects_cache()
-    #print("projects: cache refreshed")
+def get_single_flight_stats():
+  """Return per-operation counts of reads sent to Notion and reads saved by coalescing."""
+  return {op: dict(counts) for op, counts in _single_flight_stats.items()}
 
-def get_projects_map():
-    """Return a map of project_id -> project_name. Cached in _projects_cache until invalidated.
-    The cache is refreshed only when `invalidate_projects_cache()` is called.
-    """
-    global _projects_cache
-    if _projects_cache is not None:
-        #print("projects: cache hit")
-        return _projects_cache
-
-    response = notion.data_sources.query(
-        data_source_id=NOTION_PROJECTS_ID,
-        filter={
-          "property": "Archive",
-          "checkbox": {
-            "equals": False
-          }
-        }
+_projects_cache = None
+_projects_fetched_at = 0.0
+_projects_version = 0
+_projects_refresh_task = None
+# targeted project lookups share Notion's request budget with everything else, so keep them few
+_project_lookups = asyncio.Semaphore(3)
+# same for task details read in bulk
+_details_reads = asyncio.Semaphore(3)
+
+def _store_projects(projects, fetched_at):
+    """Swap in a new projects map and persist it so the next cold start doesn't wait on Notion."""
+    global _projects_cache, _projects_fetched_at, _projects_version
+    _projects_cache = projects
+    _projects_fetched_at = fetched_at
+    _projects_version += 1
+    task_mirror.save_projects(projects, fetched_at)
+
+async def _fetch_projects():
+    """Read every non-archived project from Notion and cache the id -> name map."""
+    return await _single_flight(("projects",), _load_projects)
+
+async def _load_projects():
+    PROJECTS_REFRESHES.inc()
+    pages = _iter_query_pages(
+        config.require("NOTION_PROJECTS_ID"),
+        properties=PROJECT_PROPERTIES,
+        filter=_checkbox("Archive", False),
     )
     projects = {}
-    for page in response.get("results", []):
-        name_prop = page.get("properties", {}).get("Name", {}).get("title")
-        name = name_prop[0].get("plain_text") if isinstance(name_prop, list) and len(name_prop) > 0 else ""
-        projects[page.get("id")] = name
+    async for results in pages:
+        for page in results:
+            name_prop = page.get("properties", {}).get("Name", {}).get("title")
+            name = name_prop[0].get("plain_text") if isinstance(name_prop, list) and len(name_prop) > 0 else ""
+            projects[page.get("id")] = name
 
-    _projects_cache = projects
-    #print("projects: cache refreshed")
+    _store_projects(projects, time.time())
     return projects
 
+async def _revalidate_projects():
+    try:
+        await _fetch_projects()
+    except Exception as e:
+        print("❌ Projects refresh failed:", e)
+
+def _revalidate_projects_in_background():
+    global _projects_refresh_task
+    if _projects_refresh_task is None or _projects_refresh_task.done():
+        _projects_refresh_task = asyncio.get_running_loop().create_task(_revalidate_projects())
+
+
+async def refresh_projects():
+    """Force-refresh the projects cache from Notion and return how many projects were loaded."""
+    projects = await _fetch_projects()
+    return len(projects)
+
+async def get_projects_map():
+    """Return a map of project_id -> project_name.
 
-def _ensure_projects_for_ids(project_ids):
-    """Ensure cached projects contain all project_ids. If some are missing, invalidate and re-fetch cache.
-    Returns the (possibly refreshed) projects map.
+    The map is loaded from disk on a cold start and from Notion only if there is no saved copy.
+    Once it is older than PROJECTS_CACHE_TTL the cached map is still returned, and a refresh runs
+    in the background (stale-while-revalidate).
     """
-    if not project_ids:
-        return get_projects_map()
-    projects = get_projects_map()
+    global _projects_cache, _projects_fetched_at
+    if _projects_cache is None:
+        stored = task_mirror.load_projects()
+        if stored is not None:
+            _projects_cache, _projects_fetched_at = stored
+
+    if _projects_cache is None:
+        return await _fetch_projects()
+    if time.time() - _projects_fetched_at > PROJECTS_CACHE_TTL:
+        _revalidate_projects_in_background()
+    return _projects_cache
+
+async def prewarm():
+    """Load the projects map ahead of the first request (from disk, or from Notion on a first run)
+    and the tasks schema used to project task queries.
+    """
+    await asyncio.gather(get_projects_map(), _projection(config.require("NOTION_TASKS_ID"), TASK_PROPERTIES))
+
+def projects_loaded():
+    return _projects_cache is not None
+
+async def _resolve_project(project_id):
+    """Look up a single project. Archived, trashed and inaccessible projects resolve to ""."""
+    return await _single_flight(("project", project_id), lambda: _lookup_project(project_id))
+
+async def _lookup_project(project_id):
+    async with _project_lookups:
+        try:
+            page = await _retrieve_page(project_id, config.require("NOTION_PROJECTS_ID"), PROJECT_PROPERTIES + ("Archive",))
+        except APIResponseError as e:
+            if e.code in (APIErrorCode.ObjectNotFound, APIErrorCode.RestrictedResource):
+                return ""
+            raise
+    props = page.get("properties", {})
+    if page.get("archived") or page.get("in_trash") or (props.get("Archive") or {}).get("checkbox"):
+        return ""
+    name_prop = props.get("Name", {}).get("title")
+    return name_prop[0].get("plain_text") if isinstance(name_prop, list) and len(name_prop) > 0 else ""
+
+async def _ensure_projects_for_ids(project_ids):
+    """Ensure cached projects contain all project_ids and return the projects map.
+    Missing ids are looked up one by one; archived or unknown ones are cached as "" so they
+    aren't looked up again until the next refresh.
+    """
+    projects = await get_projects_map()
     missing = [pid for pid in project_ids if pid not in projects]
+    if len(project_ids) > len(missing):
+        PROJECTS_CACHE.labels("hit").inc(len(project_ids) - len(missing))
     if missing:
-        # Invalidate and re-fetch once when we see an unknown project id
-        _invalidate_projects_cache()
-        projects = get_projects_map()
+        PROJECTS_CACHE.labels("miss").inc(len(missing))
+        names = await asyncio.gather(*(_resolve_project(pid) for pid in missing))
+        projects = {**_projects_cache, **dict(zip(missing, names))}
+        _store_projects(projects, _projects_fetched_at)
     return projects
 
-def _parse_date_for_sort(s):
-    """Return a date object for ISO date string s, or None if missing/invalid."""
-    if not s or s == "NONE":
-        return None
+_by_sort_key = attrgetter("sort_key")
+
+# Query building: the smallest filters that express what we ask for, and only the properties we read
+
+# properties read by _page_to_row and _load_projects
+TASK_PROPERTIES = ("Name", "Project", "Priority", "Planned start", "Due date", "Description", "Printed", "Done")
+PROJECT_PROPERTIES = ("Name",)
+
+def _all(*clauses):
+  return clauses[0] if len(clauses) == 1 else {"and": list(clauses)}
+
+def _any(*clauses):
+  return clauses[0] if len(clauses) == 1 else {"or": list(clauses)}
+
+def _checkbox(name, value):
+  return {"property": name, "checkbox": {"equals": value}}
+
+def _not_done():
+  return {"property": "Done", "status": {"does_not_equal": "Done"}}
+
+def _planned_by(today):
+  """Planned start on or before today, or not planned at all."""
+  return _any(
+    {"property": "Planned start", "date": {"on_or_before": today}},
+    {"property": "Planned start", "date": {"is_empty": True}},
+  )
+
+def _edited_since(since):
+  return {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since}}
+
+# data source id -> {property name: property id}
+_property_ids = {}
+
+async def _load_property_ids(data_source_id):
+  schema = await _timed("retrieve", _client().data_sources.retrieve(data_source_id=data_source_id))
+  ids = {name: prop["id"] for name, prop in (schema.get("properties") or {}).items() if prop.get("id")}
+  _property_ids[data_source_id] = ids
+  return ids
+
+async def _projection(data_source_id, names):
+  """Return the filter_properties ids for names, or None (all properties) if the schema can't be read.
+  Notion only accepts property ids there, so each data source's schema is read once per process.
+  """
+  ids = _property_ids.get(data_source_id)
+  if ids is None:
     try:
-        # handle both date-only and datetime ISO strings
-        if 'T' in s:
-            return datetime.fromisoformat(s).date()
-        return date.fromisoformat(s)
-    except Exception:
-        return None
-      
-def _sort_key(t):
-    """Sort by: 1) due_date (earliest first, missing last), 2) priority (High->Medium->Low->Optional), 3) planned_start (earliest first, missing last), 4) title."""
-    due = _parse_date_for_sort(t.get("due_date"))
-    planned = _parse_date_for_sort(t.get("planned_start"))
-
-    # Priority ordering: lower number sorts first (higher priority)
-    priority_str = (t.get("priority") or "").strip().lower()
-    priority_order = {
-        "high": 0,
-        "medium": 1,
-        "low": 2,
-        "optional": 3,
-    }
-    pr_rank = priority_order.get(priority_str, 4)
-
-    # (due_missing, due_value, priority_rank, planned_missing, planned_value, title)
-    return (
-        due is None,
-        due or date.max,
-        pr_rank,
-        planned is None,
-        planned or date.max,
-        (t.get("title") or "").lower(),
-    )
-  
-def _fetch_tasks_with_filter(filter_dict):
-  """Fetch tasks from Notion with the given filter."""
-  response = notion.data_sources.query(
-    data_source_id=NOTION_TASKS_ID,
-    filter=filter_dict
+      ids = await _single_flight(("schema", data_source_id), lambda: _load_property_ids(data_source_id))
+    except Exception as e:
+      print("❌ Could not read the data source schema, querying all properties:", e)
+      return None
+  wanted = [ids[name] for name in names if name in ids]
+  return wanted or None
+
+async def _retrieve_page(page_id, data_source_id, properties):
+  """Retrieve a page of data_source_id with only `properties` (names) in the result."""
+  filter_properties = await _projection(data_source_id, properties)
+  kwargs = {"filter_properties": filter_properties} if filter_properties else {}
+  return await _timed("retrieve", _client().pages.retrieve(page_id=page_id, **kwargs))
+
+async def _iter_query_pages(data_source_id, properties=None, **kwargs):
+  """Yield the results of every page of a data source query, following has_more/next_cursor.
+  With properties (names), results only carry those properties.
+  The next page is requested in the background while the caller is still handling the current one.
+  """
+  if properties:
+    filter_properties = await _projection(data_source_id, properties)
+    if filter_properties:
+      kwargs["filter_properties"] = filter_properties
+  pending = asyncio.ensure_future(_timed("query", _client().data_sources.query(data_source_id=data_source_id, **kwargs)))
+  try:
+    while pending is not None:
+      response = await pending
+      cursor = response.get("next_cursor")
+      pending = None
+      if response.get("has_more") and cursor:
+        pending = asyncio.ensure_future(_timed("query", _client().data_sources.query(data_source_id=data_source_id, start_cursor=cursor, **kwargs)))
+      yield response.get("results", [])
+  finally:
+    if pending is not None:
+      pending.cancel()
+
+async def _iter_tasks_with_filter(filter_dict):
+  """Yield lists of tasks from Notion matching the filter, one list per result page.
+  Notion sorts by due date so early pages hold the most urgent tasks; each page is sorted by the tasks' sort key.
+  """
+  pages = _iter_query_pages(
+    config.require("NOTION_TASKS_ID"),
+    properties=TASK_PROPERTIES,
+    filter=filter_dict,
+    sorts=[{"property": "Due date", "direction": "ascending"}]
   )
-  
-    # collect referenced project ids from the result set so we can refresh cache only when needed
-  referenced_ids = set()
-  for page in response.get("results", []):
-    props = page.get("properties", {})
-    rel = props.get("Project") and props.get("Project").get("relation")
-    if rel:
-      for r in rel:
-        if isinstance(r, dict) and r.get("id"):
-          referenced_ids.add(r.get("id"))
-          
-  projects = _ensure_projects_for_ids(referenced_ids)
-  tasks = []
-  
-  for page in response.get("results", []):
-    props = page.get("properties", {})
+  async for results in pages:
+    rows = [_page_to_row(p) for p in results]
+    _invalidate_details(rows)
+    tasks = await _rows_to_tasks(rows)
+    # without the mirror this is the freshest copy there is, so task pages and the print job that
+    # usually follows a list read it from the details cache instead of retrieving each page again
+    for row, task in zip(rows, tasks):
+      _remember_details(row, task)
+    tasks.sort(key=_by_sort_key)
+    yield tasks
 
-    task = {
-      "id": page.get("id"),
-      "project": projects.get(props.get("Project")["relation"][0]["id"], "") if props.get("Project") and props.get("Project").get("relation") else "",
-      "priority": props.get("Priority")["select"]["name"] if props.get("Priority") and props.get("Priority").get("select") else "",
-      "title": props.get("Name")["title"][0]["plain_text"] if props.get("Name") and props.get("Name").get("title") else "",
-      "planned_start": props.get("Planned start")["date"]["start"] if props.get("Planned start") and props.get("Planned start").get("date") else "",
-      "due_date": props.get("Due date")["date"]["start"] if props.get("Due date") and props.get("Due date").get("date") else "",
-      "description": props.get("Description")["rich_text"][0]["plain_text"] if props.get("Description") and props.get("Description").get("rich_text") else "",
-    }
+def _page_to_row(page):
+  """Flatten a Notion task page into a task_mirror row (project kept as id, resolved on read).
+  This is the only place task properties are read from Notion's page format.
+  """
+  props = page.get("properties") or {}
+  project = (props.get("Project") or {}).get("relation")
+  priority = (props.get("Priority") or {}).get("select")
+  title = (props.get("Name") or {}).get("title")
+  planned_start = (props.get("Planned start") or {}).get("date")
+  due_date = (props.get("Due date") or {}).get("date")
+  description = (props.get("Description") or {}).get("rich_text")
+  status = (props.get("Done") or {}).get("status")
+  return {
+    "id": page.get("id"),
+    "project_id": project[0].get("id") if project and isinstance(project[0], dict) else None,
+    "priority": priority["name"] if priority else "",
+    "title": title[0]["plain_text"] if title else "",
+    "planned_start": planned_start["start"] if planned_start else "",
+    "due_date": due_date["start"] if due_date else "",
+    "description": description[0]["plain_text"] if description else "",
+    "printed": bool((props.get("Printed") or {}).get("checkbox")),
+    "done": bool(status and status.get("name") == "Done"),
+    "last_edited_time": page.get("last_edited_time") or "",
+  }
+
+async def _rows_to_tasks(rows):
+  """Turn mirror rows into the Task objects returned by the public getters."""
+  projects = await _ensure_projects_for_ids({r["project_id"] for r in rows if r.get("project_id")})
+  return [Task.from_row(r, projects.get(r["project_id"], "") if r.get("project_id") else "") for r in rows]
+
+# ids of tasks seen to change (by a sync, a write through the app or a webhook) since the last pop_changed_task_ids()
+_changed_task_ids = set()
+
+def pop_changed_task_ids():
+  """Return and forget the ids of tasks that changed since the previous call, printed or not."""
+  ids = set(_changed_task_ids)
+  _changed_task_ids.clear()
+  return ids
+
+_sync_lock = asyncio.Lock()
+_last_synced_at = None
+
+async def _sync_task_mirror_locked(full):
+  global _last_synced_at
+  started = datetime.now(timezone.utc)
+  cursor = task_mirror.get_state("last_edited_cursor")
+  last_full = float(task_mirror.get_state("last_full_sync_at", 0))
+
+  if full or not cursor or time.time() - last_full > TASK_FULL_SYNC_INTERVAL:
+    pages = _iter_query_pages(config.require("NOTION_TASKS_ID"), properties=TASK_PROPERTIES, filter=_not_done())
+    rows = [_page_to_row(p) async for results in pages for p in results]
+    _invalidate_details(rows)
+    _changed_task_ids.update(await asyncio.to_thread(task_mirror.replace_tasks, rows))
+    await asyncio.to_thread(task_mirror.set_state, last_full_sync_at=time.time())
+  else:
+    # Notion rounds last_edited_time down to the minute, so look back a little further
+    since = datetime.fromisoformat(cursor) - timedelta(minutes=1)
+    pages = _iter_query_pages(config.require("NOTION_TASKS_ID"), properties=TASK_PROPERTIES, filter=_edited_since(since.isoformat()))
+    rows = [_page_to_row(p) async for results in pages for p in results]
+    _invalidate_details(rows)
+    _changed_task_ids.update(await asyncio.to_thread(task_mirror.upsert_tasks, rows))
+
+  _last_synced_at = time.time()
+  await asyncio.to_thread(task_mirror.set_state, last_edited_cursor=started.isoformat(), last_synced_at=_last_synced_at)
+  return len(rows)
+
+async def sync_task_mirror(full=False):
+  """Bring the local task mirror up to date with Notion.
 
-    tasks.append(task)
+  A delta sync only asks for pages edited since the previous sync. A full sync re-reads every
+  open task and replaces the mirror; it runs on first use, every TASK_FULL_SYNC_INTERVAL seconds
+  (to drop deleted/trashed pages, which deltas can't see), or when forced with full=True.
+  """
+  async with _sync_lock:
+    return await _sync_task_mirror_locked(full)
 
-  tasks.sort(key=_sort_key)
+def _mirror_enabled():
+  return TASK_MAX_STALENESS > 0
+
+def get_sync_status():
+  """Return whether the task mirror is enabled and how many seconds ago it last synced (None if never)."""
+  if not _mirror_enabled():
+    return {"enabled": False, "synced_seconds_ago": None}
+  return {"enabled": True, "synced_seconds_ago": round(time.time() - _last_synced_at, 1) if _last_synced_at else None}
+
+async def get_tasks_version():
+  """Return a token that changes whenever mirrored tasks, project names or the date change.
+  Returns None when the mirror is disabled, since then there is nothing cheap to compare.
+  """
+  if not _mirror_enabled():
+    return None
+  await _ensure_mirror_fresh()
+  return (task_mirror.version(), _projects_version, date.today().isoformat())
+
+def _mirror_is_fresh():
+  global _last_synced_at
+  if _last_synced_at is None:
+    _last_synced_at = float(task_mirror.get_state("last_synced_at", 0))
+  return time.time() - _last_synced_at <= TASK_MAX_STALENESS
+
+# monotonic time of the last failed sync; reads serve the mirror as it is for TASK_SYNC_INTERVAL after one
+_sync_failed_at = None
+
+def _sync_failed(e):
+  global _sync_failed_at
+  _sync_failed_at = time.monotonic()
+  print("❌ Task mirror sync failed:", e)
+
+async def _foreground_sync():
+  async with _sync_lock:
+    # the background sync may have run while we waited for the lock
+    if _mirror_is_fresh():
+      return
+    try:
+      await _sync_task_mirror_locked(False)
+    except Exception as e:
+      _sync_failed(e)
+      if not _last_synced_at:
+        # never synced: there is no mirror to fall back on
+        raise
+
+async def _ensure_mirror_fresh():
+  """Sync in the foreground if the mirror is older than TASK_MAX_STALENESS seconds.
+
+  Concurrent reads share one sync. If it fails (e.g. Notion is down), reads are served from the
+  mirror as it is, and no new foreground sync is tried until TASK_SYNC_INTERVAL has passed.
+  """
+  if _mirror_is_fresh():
+    return
+  if _last_synced_at and _sync_failed_at is not None and time.monotonic() - _sync_failed_at < TASK_SYNC_INTERVAL:
+    return
+  await _single_flight(("mirror_sync",), _foreground_sync)
+
+_sync_task = None
+
+async def _background_sync_loop():
+  while True:
+    try:
+      await sync_task_mirror()
+    except Exception as e:
+      _sync_failed(e)
+    await asyncio.sleep(TASK_SYNC_INTERVAL)
+
+def start_background_sync():
+  """Start a task on the running event loop that syncs the task mirror every TASK_SYNC_INTERVAL seconds."""
+  global _sync_task
+  if not _mirror_enabled() or _sync_task is not None:
+    return _sync_task
+  _sync_task = asyncio.get_running_loop().create_task(_background_sync_loop())
+  return _sync_task
+
+def stop_background_sync():
+  global _sync_task
+  if _sync_task is not None:
+    _sync_task.cancel()
+    _sync_task = None
+
+def close_write_pipeline():
+  """Stop the page update workers; they are started again by the next write."""
+  _writes.close()
+
+def get_write_pipeline_stats():
+  return {"merged": _writes.merged}
+
+def _tasks_to_print_filter(today):
+  return _all(_not_done(), _checkbox("Printed", False), _planned_by(today))
+
+async def iter_tasks_to_print():
+  """Yield batches of tasks as soon as they are available: one batch from the local mirror, or one per Notion result page."""
+  today = date.today().isoformat()
+  if _mirror_enabled():
+    await _ensure_mirror_fresh()
+    tasks = await _rows_to_tasks(task_mirror.tasks_to_print(today))
+    tasks.sort(key=_by_sort_key)
+    yield tasks
+    return
+  async for batch in _iter_tasks_with_filter(_tasks_to_print_filter(today)):
+    yield batch
+
+async def _collect_tasks(batches):
+  tasks = [task async for batch in batches for task in batch]
+  tasks.sort(key=_by_sort_key)
   return tasks
 
-def get_tasks_to_print():
+async def get_tasks_to_print():
   """Return list of tasks to print (not done, planned start <= today or no planned start, not printed)."""
   today = date.today().isoformat()
-  filter_dict={
-      "or": [
-        {
-          "and": [
-            {
-              "property": "Done",
-              "status": {
-                "does_not_equal": "Done"
-              }
-            },
-            {
-              "property": "Planned start",
-              "date": {
-                "on_or_before": today
-              }
-            },
-            {
-              "property": "Printed",
-              "checkbox": {
-                "equals": False
-              }
-            }
-          ]
-        },
-        {
-          "and": [
-            {
-              "property": "Done",
-              "status": {
-                "does_not_equal": "Done"
-              }
-            },
-            {
-              "property": "Planned start",
-              "date": {
-                "is_empty": True
-              }
-            },
-            {
-              "property": "Printed",
-              "checkbox": {
-                "equals": False
-              }
-            }
-          ]
-        }
-      ]
-    }
-  
-  return _fetch_tasks_with_filter(filter_dict)
+  return await _single_flight(("tasks_to_print", today), lambda: _collect_tasks(iter_tasks_to_print()))
 
-def get_todo_summary_to_print():
-  """Return list of tasks for daily summary (not done, planned start <= today or no planned start)."""
+def _todo_summary_filter(today):
+  return _all(_not_done(), _planned_by(today))
+
+async def iter_todo_summary_to_print():
+  """Yield batches of tasks as soon as they are available: one batch from the local mirror, or one per Notion result page."""
   today = date.today().isoformat()
-  filter_dict={
-      "or": [
-        {
-          "and": [
-            {
-              "property": "Done",
-              "status": {
-                "does_not_equal": "Done"
-              }
-            },
-            {
-              "property": "Planned start",
-              "date": {
-                "on_or_before": today
-              }
-            }
-          ]
-        },
-        {
-          "and": [
-            {
-              "property": "Done",
-              "status": {
-                "does_not_equal": "Done"
-              }
-            },
-            {
-              "property": "Planned start",
-              "date": {
-                "is_empty": True
-              }
-            }
-          ]
-        }
-      ]
-    }
-  
-  return _fetch_tasks_with_filter(filter_dict)
-
-def mark_task_as_printed(id: str):
-  notion.pages.update(
-    page_id=id,
-    properties={
-      "Printed": {
-        "checkbox": True
-      }
+  if _mirror_enabled():
+    await _ensure_mirror_fresh()
+    tasks = await _rows_to_tasks(task_mirror.todo_summary(today))
+    tasks.sort(key=_by_sort_key)
+    yield tasks
+    return
+  async for batch in _iter_tasks_with_filter(_todo_summary_filter(today)):
+    yield batch
+
+# page id -> (row the details were built from, projects version, details), least recently used first
+_details_cache = OrderedDict()
+_details_cache_stats = {"hits": 0, "misses": 0}
+
+def _cached_details(id):
+  entry = _details_cache.get(id)
+  if entry is None or entry[1] != _projects_version:
+    _details_cache_stats["misses"] += 1
+    return None
+  _details_cache.move_to_end(id)
+  _details_cache_stats["hits"] += 1
+  return entry[2]
+
+def _remember_details(row, task):
+  _details_cache[row["id"]] = (row, _projects_version, task)
+  _details_cache.move_to_end(row["id"])
+  if len(_details_cache) > TASK_DETAILS_CACHE_SIZE:
+    _details_cache.popitem(last=False)
+
+def _invalidate_details(rows):
+  """Drop cached details that rows (fresh from Notion) show to be out of date."""
+  for row in rows:
+    entry = _details_cache.get(row["id"])
+    if entry is None:
+      continue
+    edited, cached_edited = row["last_edited_time"], entry[0]["last_edited_time"]
+    # last_edited_time only has minute precision, so a tie still needs a look at the content
+    if edited > cached_edited or (edited == cached_edited and row != entry[0]):
+      del _details_cache[row["id"]]
+      _changed_task_ids.add(row["id"])
+
+def get_details_cache_stats():
+  return {"size": len(_details_cache), **_details_cache_stats}
+
+async def _details_from_row(row):
+  task = (await _rows_to_tasks([row]))[0]
+  _remember_details(row, task)
+  return task
+
+async def _write_through(page):
+  """Store a page returned by Notion in the local mirror and the details cache so reads see it immediately."""
+  if not isinstance(page, dict) or not page.get("id"):
+    return
+  row = _page_to_row(page)
+  if _mirror_enabled():
+    await asyncio.to_thread(task_mirror.upsert_tasks, [row])
+  _changed_task_ids.add(row["id"])
+  await _details_from_row(row)
+
+async def mark_task_as_printed(id: str):
+  page = await _writes.submit(id, {
+    "Printed": {
+      "checkbox": True
     }
-  )
+  })
+  await _write_through(page)
 
-def unmark_task_as_printed(id: str):
-  notion.pages.update(
-    page_id=id,
-    properties={
-      "Printed": {
-        "checkbox": False
-      }
+async def unmark_task_as_printed(id: str):
+  page = await _writes.submit(id, {
+    "Printed": {
+      "checkbox": False
     }
-  )
+  })
+  await _write_through(page)
 
-def mark_task_as_done(id: str):
-  notion.pages.update(
-    page_id=id,
-    properties={
-      "Done": {
-        "status": {
-          "name": "Done"
-        }
+async def mark_task_as_done(id: str):
+  page = await _writes.submit(id, {
+    "Done": {
+      "status": {
+        "name": "Done"
       }
     }
-  )
-  
-
-def get_task_details(id: str):
-  page = notion.pages.retrieve(page_id=id)
-  props = page.get("properties", {})
-  
-  # ensure projects cache contains referenced project id (if any)
-  rel = props.get("Project") and props.get("Project").get("relation")
-  referenced_id = None
-  if rel and isinstance(rel, list) and len(rel) > 0 and isinstance(rel[0], dict):
-    referenced_id = rel[0].get("id")
-    
-  projects = _ensure_projects_for_ids({referenced_id} if referenced_id else set())
-
-  task = {
-    "id": page.get("id"),
-    "project": projects.get(props.get("Project")["relation"][0]["id"], "") if props.get("Project") and props.get("Project").get("relation") else "",
-    "priority": props.get("Priority")["select"]["name"] if props.get("Priority") and props.get("Priority").get("select") else "",
-    "title": props.get("Name")["title"][0]["plain_text"] if props.get("Name") and props.get("Name").get("title") else "",
-    "planned_start": props.get("Planned start")["date"]["start"] if props.get("Planned start") and props.get("Planned start").get("date") else "",
-    "due_date": props.get("Due date")["date"]["start"] if props.get("Due date") and props.get("Due date").get("date") else "",
-    "description": props.get("Description")["rich_text"][0]["plain_text"] if props.get("Description") and props.get("Description").get("rich_text") else "",
-    "printed": props.get("Printed")["checkbox"] if props.get("Printed") and props.get("Printed").get("checkbox") else False,
-    "done": True if props.get("Done") and props.get("Done").get("status") and props.get("Done")["status"].get("name") == "Done" else False,
-  }
-  
-  return task
+  })
+  await _write_through(page)
+
+async def _retrieve_page_or_none(page_id):
+  """Retrieve a page, or None if it no longer exists or the integration lost access to it."""
+  try:
+    return await _timed("retrieve", _client().pages.retrieve(page_id=page_id))
+  except APIResponseError as e:
+    if e.code in (APIErrorCode.ObjectNotFound, APIErrorCode.RestrictedResource):
+      return None
+    raise
+
+def _parent_ids(page):
+  parent = (page or {}).get("parent") or {}
+  return {parent.get("id"), parent.get("data_source_id"), parent.get("database_id")} - {None}
+
+def _set_project_name(project_id, name):
+  """Patch one project in the cached map. Only cached details showing that project are dropped;
+  the rest are carried over to the new projects version.
+  """
+  _store_projects({**_projects_cache, project_id: name}, _projects_fetched_at)
+  for key, (row, version, task) in list(_details_cache.items()):
+    if row.get("project_id") == project_id:
+      del _details_cache[key]
+      _changed_task_ids.add(key)
+    elif version == _projects_version - 1:
+      _details_cache[key] = (row, _projects_version, task)
+
+async def refresh_page(page_id, parent_ids=(), deleted=False):
+  """Bring the local copies of one task or project page up to date, e.g. after a webhook event.
+
+  parent_ids are the ids of the page's parent as reported by the event (database and/or data
+  source). If they don't name the tasks or projects data source, the page is retrieved to find
+  out what it is. Returns "updated", "removed", "unchanged" or "ignored" (not a task or project).
+  """
+  tasks_id, projects_id = config.require("NOTION_TASKS_ID"), config.require("NOTION_PROJECTS_ID")
+  parent_ids = set(parent_ids) - {None}
+  page = None
+  if not deleted and not parent_ids & {tasks_id, projects_id}:
+    page = await _retrieve_page_or_none(page_id)
+    if page is not None:
+      parent_ids = _parent_ids(page)
+
+  if projects_id in parent_ids or (_projects_cache is not None and page_id in _projects_cache):
+    if _projects_cache is None:
+      # nothing cached yet; the whole map is loaded on first use
+      return "ignored"
+    name = "" if deleted else await _lookup_project(page_id)
+    if _projects_cache.get(page_id) == name:
+      return "unchanged"
+    _set_project_name(page_id, name)
+    return "updated"
+
+  known = page_id in _details_cache or (_mirror_enabled() and task_mirror.get_task(page_id) is not None)
+  if tasks_id not in parent_ids and not known:
+    return "ignored"
+  if page is None and not deleted:
+    page = await _retrieve_page_or_none(page_id)
+  if deleted or page is None or page.get("archived") or page.get("in_trash") or tasks_id not in _parent_ids(page):
+    if not known and _mirror_enabled():
+      return "unchanged"
+    _details_cache.pop(page_id, None)
+    if _mirror_enabled():
+      # under the sync lock so a sync that read the page before it went away can't put it back
+      async with _sync_lock:
+        await asyncio.to_thread(task_mirror.delete_tasks, [page_id])
+    _changed_task_ids.add(page_id)
+    return "removed"
+
+  row = _page_to_row(page)
+  _invalidate_details([row])
+  if _mirror_enabled():
+    changed = await asyncio.to_thread(task_mirror.upsert_tasks, [row])
+    _changed_task_ids.update(changed)
+    return "updated" if changed else "unchanged"
+  # without the mirror task lists always come from Notion, so there is nothing to compare against
+  _changed_task_ids.add(page_id)
+  return "updated"
+
+async def get_task_details(id: str):
+  return await _single_flight(("task_details", id), lambda: _get_task_details(id))
+
+async def get_many_task_details(ids):
+  """Return {id: Task, or the exception raised for it} for many tasks at once.
+  Mirrored and cached tasks are served locally; the rest are retrieved a few at a time.
+  """
+  async def one(id):
+    async with _details_reads:
+      return await get_task_details(id)
+  results = await asyncio.gather(*(one(id) for id in ids), return_exceptions=True)
+  return dict(zip(ids, results))
+
+async def _get_task_details(id):
+  if _mirror_enabled():
+    await _ensure_mirror_fresh()
+  cached = _cached_details(id)
+  if cached is not None:
+    return cached
+
+  if _mirror_enabled():
+    row = task_mirror.get_task(id)
+    if row:
+      return await _details_from_row(row)
+
+  page = await _retrieve_page(id, config.require("NOTION_TASKS_ID"), TASK_PROPERTIES)
+  row = _page_to_row(page)
+  if _mirror_enabled():
+    await asyncio.to_thread(task_mirror.upsert_tasks, [row])
+  return await _details_from_row(row)
 
 if __name__ == "__main__":
-  tasks = get_tasks_to_print()
+  tasks = asyncio.run(get_tasks_to_print())
   for task in tasks:
     print(task)
\ No newline at end of file
@@ -1,30 +1,367 @@
-import os
-import textwrap
-from dotenv import load_dotenv
-from escpos.printer import Network
-from datetime import datetime
-from sc_task_receipts.db import peek_next_receipt_number, commit_receipt_number, RECEIPT_NUMBER_RESET_AT
+import time
+import select
+import socket
+import threading
+from zlib import crc32
+from sc_task_receipts import config
+from sc_task_receipts.db import reserve_receipt_numbers
+from sc_task_receipts.rendering import PAPER_WIDTH_MM, render_task_receipt, iter_todo_summary_receipt
+from sc_task_receipts.metrics import PRINTER_SECONDS, RECEIPT_BYTES, PRINT_FAILURES
 
-load_dotenv()
+PRINTER_PORT = int(config.get("PRINTER_PORT", 9100))
+# Seconds an idle printer connection is kept open between receipts
+PRINTER_KEEPALIVE = float(config.get("PRINTER_KEEPALIVE", "30"))
+# Several printers as name=host[:port][@paper width mm], comma separated. PRINTER_IP is used if unset.
+PRINTERS = config.get("PRINTERS", "")
+# least_busy: each receipt goes to the printer with the fewest receipts in flight
+# project: receipts of the same project go to the same printer while it is available
+PRINTER_ROUTING = config.get("PRINTER_ROUTING", "least_busy").strip().lower()
+# Seconds a printer's circuit stays open (receipts skip it) before it is probed again
+PRINTER_RETRY_AFTER = float(config.get("PRINTER_RETRY_AFTER", "30"))
+# Consecutive failures that open a printer's circuit
+PRINTER_FAILURE_THRESHOLD = int(config.get("PRINTER_FAILURE_THRESHOLD", "1"))
+# Seconds to wait for a TCP connection or a status reply; sending a receipt still allows 10 seconds
+PRINTER_CONNECT_TIMEOUT = float(config.get("PRINTER_CONNECT_TIMEOUT", "3"))
+# Seconds between probes while a print job waits for a printer to come back
+PRINTER_PROBE_INTERVAL = float(config.get("PRINTER_PROBE_INTERVAL", "5"))
 
-PRINTER_IP = os.getenv("PRINTER_IP")
-PRINTER_PORT = int(os.getenv("PRINTER_PORT", 9100))
-PAPER_WIDTH_MM = int(os.getenv("PAPER_WIDTH_MM", 80))
-BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
-SPECIAL_INDENT = int(os.getenv("SPECIAL_INDENT", 4))
-NO_PROJECT_TEXT = os.getenv("NO_PROJECT_TEXT", "No Project")
-  
-PIXELS_MAP = {58: 384, 80: 576}
-MEDIA_WIDTH_PIXELS = PIXELS_MAP.get(PAPER_WIDTH_MM, 576)
+# ESC/POS real-time status requests: DLE EOT 1 (printer status) and DLE EOT 4 (paper roll sensor)
+_STATUS_REQUEST = b"\x10\x04\x01\x10\x04\x04"
+_STATUS_OFFLINE = 0x08
+_PAPER_NEAR_END = 0x0C
+_PAPER_END = 0x60
 
-CHARS_PER_LINE_MAP = {58: 32, 80: 48}
-CHARS_PER_LINE = CHARS_PER_LINE_MAP.get(PAPER_WIDTH_MM, 48)
 
-if not PRINTER_IP:
-    raise ValueError("PRINTER_IP is not set in .env!")
+class PrinterUnavailable(OSError):
+  """The printer could not be reached. Nothing was sent, so the receipt can go to another printer."""
 
 
-def print_task_receipt(id: str, project: str, priority: str, title: str, planned_start: str, due_date: str, description: str):
+class NoPrinterAvailable(PrinterUnavailable):
+  """Every printer is down or its circuit is open, so nothing was tried."""
+
+
+class PrinterConnection:
+  """A TCP connection to the printer that is kept open across receipts.
+
+  The socket is health-checked before each write and reopened when the printer has closed it
+  or it sat idle for longer than `keepalive` seconds. Each receipt is sent with a single sendall().
+  """
+
+  def __init__(self, host, port, timeout=10, keepalive=PRINTER_KEEPALIVE, connect_timeout=PRINTER_CONNECT_TIMEOUT):
+    self.host = host
+    self.port = port
+    self.timeout = timeout
+    self.keepalive = keepalive
+    self.connect_timeout = connect_timeout
+    self._sock = None
+    self._last_used = 0.0
+    self._lock = threading.Lock()
+
+  def _is_healthy(self):
+    if self._sock is None:
+      return False
+    if time.monotonic() - self._last_used > self.keepalive:
+      return False
+    try:
+      # a readable socket with no data means the printer closed its end
+      readable, _, _ = select.select([self._sock], [], [], 0)
+      if readable and not self._sock.recv(1, socket.MSG_PEEK):
+        return False
+    except OSError:
+      return False
+    return True
+
+  def _connect(self):
+    self._close()
+    with PRINTER_SECONDS.labels("connect").time():
+      self._sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+    self._sock.settimeout(self.timeout)
+    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def _close(self):
+    if self._sock is not None:
+      try:
+        self._sock.close()
+      except OSError:
+        pass
+      self._sock = None
+
+  def _ensure_connected(self):
+    if not self._is_healthy():
+      try:
+        self._connect()
+      except OSError as e:
+        raise PrinterUnavailable(f"Printer {self.host}:{self.port} is unreachable: {e}") from e
+
+  def probe(self):
+    """Check that the printer answers: connect if needed, then ask for its real-time status.
+
+    Uses the shared connection, since many network printers accept only one at a time.
+    Returns {"online": ..., "paper": "ok" | "low" | "out" | "unknown"}; raises PrinterUnavailable.
+    """
+    with self._lock:
+      self._ensure_connected()
+      with PRINTER_SECONDS.labels("probe").time():
+        try:
+          self._sock.settimeout(self.connect_timeout)
+          # drop status bytes left over from an earlier probe that timed out
+          self._sock.setblocking(False)
+          try:
+            while self._sock.recv(64):
+              pass
+          except BlockingIOError:
+            pass
+          self._sock.settimeout(self.connect_timeout)
+          self._sock.sendall(_STATUS_REQUEST)
+          reply = b""
+          while len(reply) < 2:
+            chunk = self._sock.recv(2 - len(reply))
+            if not chunk:
+              raise ConnectionResetError("connection closed by printer")
+            reply += chunk
+        except socket.timeout:
+          # connected, but this printer doesn't answer status requests
+          return {"online": True, "paper": "unknown"}
+        except OSError as e:
+          self._close()
+          raise PrinterUnavailable(f"Printer {self.host}:{self.port} did not answer: {e}") from e
+        finally:
+          if self._sock is not None:
+            self._sock.settimeout(self.timeout)
+      self._last_used = time.monotonic()
+    paper = "out" if reply[1] & _PAPER_END else "low" if reply[1] & _PAPER_NEAR_END else "ok"
+    return {"online": not reply[0] & _STATUS_OFFLINE, "paper": paper}
+
+  def send(self, data):
+    """Send a complete receipt, reconnecting first if the connection is stale.
+    data is bytes, or an iterable of byte chunks that are sent as they are produced.
+    """
+    with self._lock:
+      self._ensure_connected()
+      for chunk in (data,) if isinstance(data, bytes) else data:
+        try:
+          with PRINTER_SECONDS.labels("transmit").time():
+            self._sock.sendall(chunk)
+        except OSError:
+          self._close()
+          raise
+      self._last_used = time.monotonic()
+
+  def close(self):
+    with self._lock:
+      self._close()
+
+
+class CircuitBreaker:
+  """Tracks consecutive failures of one printer.
+
+  closed: receipts are sent. open: receipts skip the printer until `cooldown` seconds have passed.
+  half_open: the cooldown is over; the printer is probed before it gets a receipt again.
+  """
+
+  CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+  def __init__(self, threshold=PRINTER_FAILURE_THRESHOLD, cooldown=PRINTER_RETRY_AFTER):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.failures = 0
+    self._opened_until = None
+
+  @property
+  def state(self):
+    if self._opened_until is None:
+      return self.CLOSED
+    return self.OPEN if time.monotonic() < self._opened_until else self.HALF_OPEN
+
+  def retry_in(self):
+    return max(0.0, self._opened_until - time.monotonic()) if self._opened_until is not None else 0.0
+
+  def success(self):
+    self.failures = 0
+    self._opened_until = None
+
+  def failure(self):
+    self.failures += 1
+    if self.failures >= self.threshold or self._opened_until is not None:
+      self._opened_until = time.monotonic() + self.cooldown
+
+
+class Printer:
+  """One printer of the pool with its paper width, load and circuit breaker."""
+
+  def __init__(self, name, host, port=PRINTER_PORT, paper_width_mm=PAPER_WIDTH_MM):
+    self.name = name
+    self.host = host
+    self.port = port
+    self.paper_width_mm = paper_width_mm
+    self.connection = PrinterConnection(host, port, timeout=10)
+    self.breaker = CircuitBreaker()
+    self.busy = 0
+    self.printed = 0
+    self.failed = 0
+    self.last_error = None
+    self.last_status = None
+
+  def probe(self):
+    """Probe the printer and update its breaker. Returns True if it can take receipts."""
+    try:
+      status = self.connection.probe()
+    except PrinterUnavailable as e:
+      self.last_error = str(e)
+      self.breaker.failure()
+      return False
+    self.last_status = status
+    if not status["online"] or status["paper"] == "out":
+      self.last_error = "Printer is offline" if not status["online"] else "Printer is out of paper"
+      self.breaker.failure()
+      return False
+    self.breaker.success()
+    return True
+
+  def status(self):
+    return {
+      "name": self.name,
+      "host": self.host,
+      "port": self.port,
+      "paper_width_mm": self.paper_width_mm,
+      "state": self.breaker.state,
+      "retry_in": round(self.breaker.retry_in(), 1),
+      "consecutive_failures": self.breaker.failures,
+      "busy": self.busy,
+      "printed": self.printed,
+      "failed": self.failed,
+      "last_status": self.last_status,
+      "last_error": self.last_error,
+    }
+
+
+class PrinterPool:
+  """Spread receipts over several printers.
+
+  Each receipt goes to one printer picked by the routing mode, among printers whose circuit is
+  not open. A printer that cannot be reached opens its circuit and the receipt moves on to the
+  next one, so one printer being off doesn't hold up a batch; once its cooldown is over it is
+  probed (short timeouts) before it gets receipts again. When no printer is left,
+  NoPrinterAvailable is raised right away instead of waiting out connection timeouts. A failure
+  after data was sent is raised as is, since the receipt may already be on paper.
+  """
+
+  def __init__(self, printers, routing=PRINTER_ROUTING):
+    self.printers = printers
+    self.routing = routing
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.printers)
+
+  def _acquire(self, project, tried):
+    """Pick the next printer to try and count it as busy, or return None if none is left."""
+    with self._lock:
+      candidates = [p for p in self.printers if p not in tried and p.breaker.state != CircuitBreaker.OPEN]
+      if not candidates:
+        return None
+      if self.routing == "project" and project:
+        # walk the pool from the project's own printer, so it only moves when that one is down
+        start = crc32(project.encode("utf-8")) % len(self.printers)
+        order = {p: (i - start) % len(self.printers) for i, p in enumerate(self.printers)}
+        printer = min(candidates, key=order.get)
+      else:
+        printer = min(candidates, key=lambda p: (p.breaker.state != CircuitBreaker.CLOSED, p.busy, p.printed))
+      printer.busy += 1
+      return printer
+
+  def send(self, render, project=None):
+    """Send render(printer) to a printer and return the printer used."""
+    tried, errors = [], []
+    while True:
+      printer = self._acquire(project, tried)
+      if printer is None:
+        raise NoPrinterAvailable("No printer available: " + "; ".join(errors or self._errors()))
+      tried.append(printer)
+      try:
+        if printer.breaker.state == CircuitBreaker.HALF_OPEN and not printer.probe():
+          errors.append(f"{printer.name}: {printer.last_error}")
+          continue
+        printer.connection.send(render(printer))
+      except PrinterUnavailable as e:
+        printer.last_error = str(e)
+        printer.breaker.failure()
+        errors.append(f"{printer.name}: {e}")
+        continue
+      except OSError as e:
+        printer.failed += 1
+        printer.last_error = str(e)
+        printer.breaker.failure()
+        raise
+      finally:
+        with self._lock:
+          printer.busy -= 1
+      printer.printed += 1
+      printer.breaker.success()
+      return printer
+
+  def _errors(self):
+    return [f"{p.name}: {p.last_error} (retry in {p.breaker.retry_in():.0f}s)" for p in self.printers]
+
+  def probe(self, force=False):
+    """Probe printers whose circuit isn't closed (every printer if force). Returns True if any can take receipts."""
+    for printer in self.printers:
+      if force or printer.breaker.state != CircuitBreaker.CLOSED:
+        printer.probe()
+    return any(p.breaker.state == CircuitBreaker.CLOSED for p in self.printers)
+
+  def close(self):
+    for printer in self.printers:
+      printer.connection.close()
+
+
+def _parse_printers(spec):
+  """Parse PRINTERS, e.g. "front=192.168.1.50:9100@80,back=192.168.1.51@58"."""
+  printers = []
+  for i, item in enumerate(item.strip() for item in spec.split(",") if item.strip()):
+    name, _, address = item.rpartition("=")
+    address, _, width = address.partition("@")
+    host, _, port = address.partition(":")
+    printers.append(Printer(name or f"printer{i + 1}", host, int(port or PRINTER_PORT), int(width or PAPER_WIDTH_MM)))
+  return printers
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+  """Return the printer pool, built from PRINTERS (or PRINTER_IP) on first use."""
+  global _pool
+  if _pool is None:
+    with _pool_lock:
+      if _pool is None:
+        printers = _parse_printers(PRINTERS) if PRINTERS.strip() else [Printer("default", config.require("PRINTER_IP"))]
+        _pool = PrinterPool(printers)
+  return _pool
+
+
+def pool_size():
+  """Number of printers receipts can be sent to in parallel."""
+  return len(_get_pool())
+
+
+def printers_status():
+  return [printer.status() for printer in _get_pool().printers]
+
+
+def probe_printers(force=False):
+  """Probe printers that are down (all of them if force). Blocking; returns True if any can take receipts."""
+  return _get_pool().probe(force)
+
+
+def close_printer_connection():
+  """Close the printer connections, e.g. once a batch of receipts is done."""
+  if _pool is not None:
+    _pool.close()
+
+
+def print_task_receipt(id: str, project: str, priority: str, title: str, planned_start: str, due_date: str, description: str, number: int = None):
   """Print a task receipt.
 
   Args:
@@ -35,136 +372,56 @@ def print_task_receipt(id: str, project: str, priority: str, title: str, planned
       planned_start (str): The planned start date for the task.
       due_date (str): The due date of the task.
       description (str): The description of the task.
+      number (int): A receipt number reserved earlier; the next one is reserved if omitted.
   """
   try:
-    printer = Network(PRINTER_IP, PRINTER_PORT, timeout=10)
-    printer.profile.profile_data["media"]["width"]["pixels"] = MEDIA_WIDTH_PIXELS
-    
-    number = peek_next_receipt_number()
-
-    # MAIN HEADER: Project
-    printer._raw(b'\x1b\x40')  # ESC/POS command to initialize printer
-    printer._raw(b'\x1b\x45\x01')  # ESC/POS command for bold on
-    printer._raw(b'\x1b\x4d\x01') # ESC/POS command for emphasized mode on
-    printer._raw(b'\x1d\x21\x22')  # ESC/POS command for change width and height
-    printer.set(align='right')
-    printer.text(f"{str(number).zfill(len(str(RECEIPT_NUMBER_RESET_AT)))}\n")
-    printer._raw(b'\x1d\x21\x11')  # ESC/POS command for change width and height
-    printer.set(align='center')
-    if project and project.strip():
-      printer.text(f"{project}\n")
-    else:
-      printer.text(f"{NO_PROJECT_TEXT}\n")
-
-    # SECONDARY HEADER: Priority
-    if priority and priority.strip():
-      printer.text(f"{priority}\n\n")
-    else:
-      printer.text("\n")
-    printer._raw(b'\x1d\x21\x00') # ESC/POS command for normal size
-    printer._raw(b'\x1b\x45\x00')  # ESC/POS command for bold off
-    printer._raw(b'\x1b\x4d\x00') # ESC/POS command for emphasized mode off
-    printer.text("-" * CHARS_PER_LINE + "\n\n")
-
-    # TASK
-    printer.set(align='left')
-    printer.text(f"Task\n")
-    wrapped_title = textwrap.wrap(title, width=CHARS_PER_LINE - SPECIAL_INDENT)
-    for line in wrapped_title:
-      printer.text(f"{' ' * SPECIAL_INDENT}{line}\n")
-    printer.text("\n")
-        
-    # DATES
-    labels_and_dates = [
-        ("Planned start", planned_start if planned_start and planned_start.strip() else "—"),
-        ("Due date", due_date if due_date and due_date.strip() else "—"),
-    ]
-    for label, value in labels_and_dates:
-      printer.text(f"{label}{value.rjust(CHARS_PER_LINE - len(label))}\n")
-    printer.text("\n")
-
-    # DESCRIPTION (only if not empty)
-    if description and description.strip():
-      printer.text("Description\n")
-      wrapped_description = textwrap.wrap(description, width=CHARS_PER_LINE - SPECIAL_INDENT)
-      for line in wrapped_description:
-        printer.text(f"{' ' * SPECIAL_INDENT}{line}\n")
-      printer.text("\n")
-    printer.set(align='center')
-    printer.text("-" * CHARS_PER_LINE + "\n")
-      
-    # QR
-    qr_data = f"{BASE_URL}/tasks/{id}"
-    printer.set(align='center')
-    printer.qr(qr_data, size=6)
-    printer.text("Scan to mark as DONE\n\n")
-    printer.text("-" * CHARS_PER_LINE + "\n\n")
-
-    # FOOTER: print timestamp
-    printer.set(align='center')
-    printer.text(f"Printed at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-    # CUT
-    printer.cut()
-    printer.close()
-    commit_receipt_number(number)
+    with PRINTER_SECONDS.labels("receipt").time():
+      if number is None:
+        number = reserve_receipt_numbers()[0]
+      task = {"id": id, "project": project, "priority": priority, "title": title, "planned_start": planned_start, "due_date": due_date, "description": description}
+
+      def render(printer):
+        data = render_task_receipt(task, number, paper_width_mm=printer.paper_width_mm)
+        RECEIPT_BYTES.labels("task").observe(len(data))
+        return data
+
+      _get_pool().send(render, project=project)
     print("✅ Task printed successfully!")
     return True
 
   except Exception as e:
+    PRINT_FAILURES.labels("task").inc()
     print("❌ Failed to print:", e)
     raise
 
-def print_todo_summary_receipt(list_of_tasks):
-  """Print a todo summary receipt."""
+def print_todo_summary_batches(batches, total=None):
+  """Print a todo summary while its tasks are still arriving.
+
+  batches is an iterable of task lists (e.g. one per Notion result page, fed from another thread);
+  each batch is rendered and sent as soon as it arrives. Since bytes may be out before the last
+  batch, the printer is only picked once, on connecting.
+  """
   try:
-    printer = Network(PRINTER_IP, PRINTER_PORT, timeout=10)
-    printer.profile.profile_data["media"]["width"]["pixels"] = MEDIA_WIDTH_PIXELS
-
-    # MAIN HEADER
-    printer._raw(b'\x1b\x40')  # ESC/POS command to initialize printer
-    printer.set(align='center')
-    printer.text("ToDo Summary\n")
-    printer.text(f"{len(list_of_tasks)} tasks\n")
-    printer.text("-" * CHARS_PER_LINE + "\n")
-
-    for task in list_of_tasks:
-      printer.set(align='left')
-      wrapped_title = textwrap.wrap(task['title'], width=CHARS_PER_LINE - 2)
-      for line in wrapped_title:
-        if line == wrapped_title[0]:
-          printer.text(f"• {line}\n")
-        else:
-          printer.text(f"{line}\n")
-      if task['due_date'] and task['due_date'].strip():
-        printer.text(f"  Due: {task['due_date']}\n")
-      if task['priority'] and task['priority'].strip():
-        printer.text(f"  Prio: {task['priority']}\n")
-      if task['planned_start'] and task['planned_start'].strip():
-        printer.text(f"  Start: {task['planned_start']}\n")
-      if task['project'] and task['project'].strip():
-        printer.text(f"  Project: {task['project']}\n")
-      if task != list_of_tasks[-1]:
-        printer.text("\n")
-
-    # FOOTER: print timestamp
-    printer.set(align='center')
-    printer.text("-" * CHARS_PER_LINE + "\n")
-    printer.text(f"Printed at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-
-    # CUT
-    printer.cut()
-    printer.close()
+    with PRINTER_SECONDS.labels("receipt").time():
+      def render(printer):
+        size = 0
+        for chunk in iter_todo_summary_receipt(batches, paper_width_mm=printer.paper_width_mm, total=total):
+          size += len(chunk)
+          yield chunk
+        RECEIPT_BYTES.labels("summary").observe(size)
+
+      _get_pool().send(render)
     print("✅ ToDo summary printed successfully!")
     return True
 
   except Exception as e:
+    PRINT_FAILURES.labels("summary").inc()
     print("❌ Failed to print:", e)
     raise
 
 if __name__ == "__main__":
   #print_task_receipt("12345", "", "", "Task Name Here", "", "", "This is an example task description that is a little long and needs to be wrapped properly.")
-  print_todo_summary_receipt([
+  print_todo_summary_batches([[
     {
       "id": "task1",
       "project": "Project Alpha",
@@ -183,4 +440,4 @@ if __name__ == "__main__":
       "due_date": "",
       "description": "Clean and organize the physical and digital workspace for better productivity."
     }
-  ])
\ No newline at end of file
+  ]])
\ No newline at end of file
@@ -0,0 +1,293 @@
+import json
+import hashlib
+import textwrap
+import threading
+from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from sc_task_receipts import config
+from sc_task_receipts.db import RECEIPT_NUMBER_RESET_AT
+
+PAPER_WIDTH_MM = int(config.get("PAPER_WIDTH_MM", 80))
+BASE_URL = config.get("BASE_URL", "http://localhost:8000")
+SPECIAL_INDENT = int(config.get("SPECIAL_INDENT", 4))
+NO_PROJECT_TEXT = config.get("NO_PROJECT_TEXT", "No Project")
+# Number of rendered receipt bodies kept in memory
+RECEIPT_CACHE_SIZE = int(config.get("RECEIPT_CACHE_SIZE", "256"))
+# Number of rendered todo summary entries kept in memory
+SUMMARY_ENTRY_CACHE_SIZE = int(config.get("SUMMARY_ENTRY_CACHE_SIZE", "1024"))
+# Let the printer generate QR codes itself (GS ( k) instead of sending a rasterized image
+QR_NATIVE = config.get_bool("QR_NATIVE")
+# Number of rasterized QR codes kept in memory when QR_NATIVE is off
+QR_CACHE_SIZE = int(config.get("QR_CACHE_SIZE", "512"))
+QR_SIZE = 6
+# Entry lines after which a todo summary is split into numbered parts with a cut between them (0 = never)
+SUMMARY_MAX_LINES = int(config.get("SUMMARY_MAX_LINES", "0"))
+
+PIXELS_MAP = {58: 384, 80: 576}
+CHARS_PER_LINE_MAP = {58: 32, 80: 48}
+
+Layout = namedtuple("Layout", ("pixels", "chars_per_line"))
+
+
+def layout_for(paper_width_mm=None):
+  """Return the layout for a paper width in mm (PAPER_WIDTH_MM if None)."""
+  width = paper_width_mm or PAPER_WIDTH_MM
+  return Layout(PIXELS_MAP.get(width, 576), CHARS_PER_LINE_MAP.get(width, 48))
+
+
+DEFAULT_LAYOUT = layout_for()
+
+TASK_FIELDS = ("id", "project", "priority", "title", "planned_start", "due_date", "description")
+
+# content hash -> rendered body bytes, least recently used first
+_body_cache = OrderedDict()
+# content hash -> (rendered summary entry bytes, lines it takes, code page it ends in), least recently used first
+_entry_cache = OrderedDict()
+# receipts render in worker threads (asyncio.to_thread), so the caches are only touched under this lock
+_cache_lock = threading.Lock()
+
+
+def _new_buffer(layout=DEFAULT_LAYOUT):
+  """Return an in-memory ESC/POS printer that only collects bytes."""
+  # escpos (with PIL, qrcode and its capability profiles) is slow to import, so only on first render
+  from escpos.printer import Dummy
+  printer = Dummy()
+  # profile_data is shared by every instance of the profile, so set the width on a copy
+  data = printer.profile.profile_data
+  media = data["media"]
+  printer.profile.profile_data = {**data, "media": {**media, "width": {**media["width"], "pixels": layout.pixels}}}
+  return printer
+
+
+def _content_key(kind, payload, layout):
+  """Hash everything that affects a rendered body, layout settings included."""
+  settings = (*layout, SPECIAL_INDENT, NO_PROJECT_TEXT, BASE_URL, QR_NATIVE)
+  blob = json.dumps([kind, settings, payload], sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+  return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _cached_body(key, render, cache=_body_cache, max_size=RECEIPT_CACHE_SIZE):
+  with _cache_lock:
+    body = cache.get(key)
+    if body is not None:
+      cache.move_to_end(key)
+      return body
+  # rendered outside the lock so threads don't queue behind each other's renders
+  body = render()
+  with _cache_lock:
+    cache[key] = body
+    if len(cache) > max_size:
+      cache.popitem(last=False)
+  return body
+
+
+def prewarm():
+  """Import the ESC/POS stack ahead of the first print. Blocking; run it in a thread."""
+  _new_buffer()
+
+
+def _render_qr_native(data):
+  """QR as ESC/POS GS ( k commands: only the data is sent, the printer draws the code."""
+  printer = _new_buffer()
+  printer.qr(data, size=QR_SIZE, native=True)
+  return printer.output
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def _render_qr_image(data):
+  """QR generated and rasterized here, for printers without native QR support. Cached per URL."""
+  printer = _new_buffer()
+  printer.qr(data, size=QR_SIZE)
+  return printer.output
+
+
+def _render_qr(data):
+  return _render_qr_native(data) if QR_NATIVE else _render_qr_image(data)
+
+
+def _render_footer(printed_at):
+  printer = _new_buffer()
+  printer.set(align='center')
+  printer.text(f"Printed at: {printed_at.strftime('%Y-%m-%d %H:%M:%S')}")
+  printer.cut()
+  return printer.output
+
+
+def _render_task_header(number):
+  printer = _new_buffer()
+  printer._raw(b'\x1b\x40')  # ESC/POS command to initialize printer
+  printer._raw(b'\x1b\x45\x01')  # ESC/POS command for bold on
+  printer._raw(b'\x1b\x4d\x01') # ESC/POS command for emphasized mode on
+  printer._raw(b'\x1d\x21\x22')  # ESC/POS command for change width and height
+  printer.set(align='right')
+  printer.text(f"{str(number).zfill(len(str(RECEIPT_NUMBER_RESET_AT)))}\n")
+  return printer.output
+
+
+def _render_task_body(task, layout):
+  printer = _new_buffer(layout)
+  chars_per_line = layout.chars_per_line
+  project, priority = task["project"], task["priority"]
+  title, description = task["title"], task["description"]
+  planned_start, due_date = task["planned_start"], task["due_date"]
+
+  # MAIN HEADER: Project
+  printer._raw(b'\x1d\x21\x11')  # ESC/POS command for change width and height
+  printer.set(align='center')
+  if project and project.strip():
+    printer.text(f"{project}\n")
+  else:
+    printer.text(f"{NO_PROJECT_TEXT}\n")
+
+  # SECONDARY HEADER: Priority
+  if priority and priority.strip():
+    printer.text(f"{priority}\n\n")
+  else:
+    printer.text("\n")
+  printer._raw(b'\x1d\x21\x00') # ESC/POS command for normal size
+  printer._raw(b'\x1b\x45\x00')  # ESC/POS command for bold off
+  printer._raw(b'\x1b\x4d\x00') # ESC/POS command for emphasized mode off
+  printer.text("-" * chars_per_line + "\n\n")
+
+  # TASK
+  printer.set(align='left')
+  printer.text(f"Task\n")
+  wrapped_title = textwrap.wrap(title, width=chars_per_line - SPECIAL_INDENT)
+  for line in wrapped_title:
+    printer.text(f"{' ' * SPECIAL_INDENT}{line}\n")
+  printer.text("\n")
+
+  # DATES
+  labels_and_dates = [
+      ("Planned start", planned_start if planned_start and planned_start.strip() else "—"),
+      ("Due date", due_date if due_date and due_date.strip() else "—"),
+  ]
+  for label, value in labels_and_dates:
+    printer.text(f"{label}{value.rjust(chars_per_line - len(label))}\n")
+  printer.text("\n")
+
+  # DESCRIPTION (only if not empty)
+  if description and description.strip():
+    printer.text("Description\n")
+    wrapped_description = textwrap.wrap(description, width=chars_per_line - SPECIAL_INDENT)
+    for line in wrapped_description:
+      printer.text(f"{' ' * SPECIAL_INDENT}{line}\n")
+    printer.text("\n")
+  printer.set(align='center')
+  printer.text("-" * chars_per_line + "\n")
+
+  # QR
+  qr_data = f"{BASE_URL}/tasks/{task['id']}"
+  printer.set(align='center')
+  printer._raw(_render_qr(qr_data))
+  printer.text("Scan to mark as DONE\n\n")
+  printer.text("-" * chars_per_line + "\n\n")
+  return printer.output
+
+
+def render_task_receipt(task, number, printed_at=None, paper_width_mm=None):
+  """Return the complete ESC/POS bytes for a task receipt.
+
+  The body (everything but the receipt number and timestamp) is cached by a hash of its content
+  and layout, so reprinting an unchanged task skips text layout and QR rasterization.
+  """
+  layout = layout_for(paper_width_mm)
+  task = {field: task.get(field) or "" for field in TASK_FIELDS}
+  body = _cached_body(_content_key("task", task, layout), lambda: _render_task_body(task, layout))
+  return _render_task_header(number) + body + _render_footer(printed_at or datetime.now())
+
+
+def _start_summary_part(layout, part, total=None):
+  """A fresh buffer holding the header of one summary receipt (ESC @ also resets the code page)."""
+  printer = _new_buffer(layout)
+  printer._raw(b'\x1b\x40')  # ESC/POS command to initialize printer
+  printer.set(align='center')
+  printer.text("ToDo Summary\n")
+  if part > 1:
+    printer.text(f"Part {part}\n")
+  if total is not None:
+    printer.text(f"{total} tasks\n")
+  printer.text("-" * layout.chars_per_line + "\n")
+  return printer
+
+
+_SUMMARY_DETAILS = (("Due", "due_date"), ("Prio", "priority"), ("Start", "planned_start"), ("Project", "project"))
+SUMMARY_FIELDS = ("title", *(field for _, field in _SUMMARY_DETAILS))
+
+
+def _render_summary_entry(printer, task, layout, encoding):
+  """Return (bytes, lines, code page at the end) for one task of the summary, rendered into the
+  scratch buffer `printer` as if the receipt was in code page `encoding` when the entry starts.
+  """
+  printer.clear()
+  printer.magic.encoding = encoding
+  wrapped_title = textwrap.wrap(task['title'], width=layout.chars_per_line - 2)
+  printer.set(align='left')
+  for i, line in enumerate(wrapped_title):
+    printer.text(f"• {line}\n" if i == 0 else f"{line}\n")
+  details = [(label, task[field]) for label, field in _SUMMARY_DETAILS if task[field].strip()]
+  for label, value in details:
+    printer.text(f"  {label}: {value}\n")
+  return printer.output, len(wrapped_title) + len(details), printer.magic.encoding
+
+
+def _summary_entry(scratch, task, layout, encoding):
+  # code page switches are only emitted when needed, so the bytes depend on the page in use
+  key = _content_key("summary_entry", {"task": task, "encoding": encoding}, layout)
+  return _cached_body(key, lambda: _render_summary_entry(scratch, task, layout, encoding), _entry_cache, SUMMARY_ENTRY_CACHE_SIZE)
+
+
+def iter_todo_summary_receipt(batches, printed_at=None, paper_width_mm=None, max_lines=None, total=None):
+  """Yield the ESC/POS bytes of a todo summary one chunk per batch of tasks, so printing can start
+  before the last batch has been fetched.
+
+  batches is an iterable of task lists (e.g. one per Notion result page). With max_lines, a summary
+  whose entries would run longer is split into numbered parts, each ending with its own footer and
+  cut. The task count goes in the header when `total` is known up front, at the end otherwise.
+  If batches raises, the receipt is closed off as incomplete (and cut) before the error propagates.
+  Entries are cached by a hash of their content and layout, so a reprint only lays out changed tasks.
+  """
+  layout = layout_for(paper_width_mm)
+  printed_at = printed_at or datetime.now()
+  max_lines = SUMMARY_MAX_LINES if max_lines is None else max_lines
+  part, count, part_lines = 1, 0, 0
+  printer = _start_summary_part(layout, part, total)
+  # entries that aren't cached are rendered here, one at a time
+  scratch = _new_buffer(layout)
+  try:
+    for batch in batches:
+      for task in batch:
+        task = {field: task.get(field) or "" for field in SUMMARY_FIELDS}
+        entry, lines, encoding = _summary_entry(scratch, task, layout, printer.magic.encoding)
+        if max_lines and part_lines and part_lines + 1 + lines > max_lines:
+          part += 1
+          printer.set(align='center')
+          printer.text("-" * layout.chars_per_line + "\n")
+          printer.text(f"Continued in part {part}\n")
+          yield printer.output + _render_footer(printed_at)
+          printer, part_lines = _start_summary_part(layout, part), 0
+          entry, lines, encoding = _summary_entry(scratch, task, layout, printer.magic.encoding)
+        if part_lines:
+          # a blank line between entries of one receipt
+          printer.text("\n")
+        printer._raw(entry)
+        printer.magic.encoding = encoding
+        part_lines += lines + (1 if part_lines else 0)
+        count += 1
+      if batch:
+        yield printer.output
+        printer.clear()
+  except Exception:
+    printer.set(align='center')
+    printer.text("-" * layout.chars_per_line + "\n")
+    printer.text(f"Incomplete: {count} tasks fetched\n")
+    yield printer.output + _render_footer(printed_at)
+    raise
+
+  printer.set(align='center')
+  if total is None:
+    printer.text("-" * layout.chars_per_line + "\n")
+    printer.text(f"{count} tasks\n")
+  printer.text("-" * layout.chars_per_line + "\n")
+  yield printer.output + _render_footer(printed_at)
@@ -0,0 +1,125 @@
+import gzip
+import hashlib
+from pathlib import Path
+from urllib.parse import parse_qs
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder, IdentityResponder
+from sc_task_receipts import config
+
+try:
+  import brotli  # optional: pip install brotli
+except ImportError:
+  brotli = None
+
+# Bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = int(config.get("COMPRESS_MIN_SIZE", "1000"))
+# Cached bodies are compressed once per version, so a higher level than per-request gzip is affordable
+_COMPRESSORS = {"gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0)}
+if brotli is not None:
+  _COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=9)
+# preferred first
+_ENCODINGS = ("br", "gzip")
+
+
+class CachedBody:
+  """A response body with a strong ETag and its compressed variants, each made on first request."""
+
+  __slots__ = ("body", "etag", "media_type", "_variants")
+
+  def __init__(self, body: bytes, media_type: str):
+    self.body = body
+    self.media_type = media_type
+    self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    self._variants = {}
+
+  def variant(self, encoding):
+    """Return (body, etag) for encoding; each encoding gets its own ETag, as the bytes differ."""
+    if encoding is None:
+      return self.body, self.etag
+    if encoding not in self._variants:
+      self._variants[encoding] = _COMPRESSORS[encoding](self.body)
+    return self._variants[encoding], self.etag[:-1] + "-" + encoding + '"'
+
+
+def _accepted_encoding(headers, encodings=_ENCODINGS):
+  """Pick the first of encodings the client accepts (honouring q=0), or None for identity."""
+  accepted = {}
+  for item in headers.get("accept-encoding", "").split(","):
+    name, _, params = item.strip().partition(";")
+    q = 1.0
+    if params.strip().startswith("q="):
+      try:
+        q = float(params.strip()[2:])
+      except ValueError:
+        q = 0.0
+    accepted[name.strip().lower()] = q
+  for encoding in encodings:
+    if encoding in _COMPRESSORS and accepted.get(encoding, accepted.get("*", 0)) > 0:
+      return encoding
+  return None
+
+
+def conditional_response(request: Request, cached: CachedBody):
+  """Send a cached body compressed for the client, or 304 if the client's copy matches."""
+  compressible = len(cached.body) >= COMPRESS_MIN_SIZE
+  encoding = _accepted_encoding(request.headers) if compressible else None
+  body, etag = cached.variant(encoding)
+  headers = {"ETag": etag, "Cache-Control": "no-cache"}
+  if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+    if compressible:
+      headers["Vary"] = "Accept-Encoding"
+    return Response(status_code=304, headers=headers)
+  if encoding is not None:
+    # an uncompressed body this size gets its Vary from CompressionMiddleware
+    headers["Content-Encoding"] = encoding
+    headers["Vary"] = "Accept-Encoding"
+  return Response(content=body, media_type=cached.media_type, headers=headers)
+
+
+class CompressionMiddleware(GZipMiddleware):
+  """gzip for responses that aren't compressed already (those from conditional_response are),
+  with the same Accept-Encoding negotiation, so e.g. "gzip;q=0" is respected. Skips SSE streams.
+  """
+
+  async def __call__(self, scope, receive, send):
+    if scope["type"] != "http":
+      return await self.app(scope, receive, send)
+    if _accepted_encoding(Headers(scope=scope), ("gzip",)):
+      responder = GZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+    else:
+      responder = IdentityResponder(self.app, self.minimum_size)
+    await responder(scope, receive, send)
+
+
+class HashedStaticFiles(StaticFiles):
+  """Static files addressed by content hash (url() adds ?v=<hash>).
+
+  A request carrying the file's current hash can never go stale, so it is cached for a year as
+  immutable; a request without it (or with an old hash) must revalidate.
+  """
+
+  IMMUTABLE = "public, max-age=31536000, immutable"
+
+  def __init__(self, directory):
+    super().__init__(directory=directory)
+    self._root = Path(directory)
+    self._hashes = {}
+
+  def file_hash(self, path):
+    if path not in self._hashes:
+      self._hashes[path] = hashlib.sha256((self._root / path).read_bytes()).hexdigest()[:12]
+    return self._hashes[path]
+
+  def url(self, path):
+    return f"{path}?v={self.file_hash(path)}"
+
+  async def get_response(self, path, scope):
+    response = await super().get_response(path, scope)
+    if response.status_code in (200, 304):
+      version = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("v", [None])[0]
+      fresh = version is not None and version == self.file_hash(path)
+      response.headers["Cache-Control"] = self.IMMUTABLE if fresh else "no-cache"
+    return response
@@ -0,0 +1,25 @@
+// Print job polling shared by the dashboard and the task page
+
+const JOB_POLL_INTERVAL = 1000; // ms
+
+// Poll a queued print job until the worker has finished it, or until it is parked "waiting"
+// for a printer: it then resumes on its own once one is back, so there is nothing to wait for
+async function waitForJob(jobId, onProgress){
+  while(true){
+    const res = await fetch(`/api/v1/jobs/${jobId}`);
+    let body = {};
+    try{ body = await res.json(); }catch(e){ /* not json */ }
+    if(!res.ok){
+      throw new Error(body.detail || body.message || `Job status request failed (status ${res.status})`);
+    }
+    const job = body.data || {};
+    if(onProgress) onProgress(job);
+    if(job.status === 'done' || job.status === 'failed' || job.status === 'waiting') return job;
+    await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+  }
+}
+
+// Toast text for a job parked waiting for a printer
+function jobWaitingMessage(job){
+  return `${job.error || 'No printer available'}. The job will resume once a printer is back.`;
+}
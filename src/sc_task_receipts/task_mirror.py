@@ -0,0 +1,235 @@
+import sqlite3
+import threading
+from sc_task_receipts.db import DB_PATH
+
+TASK_COLUMNS = (
+    "id",
+    "project_id",
+    "priority",
+    "title",
+    "planned_start",
+    "due_date",
+    "description",
+    "printed",
+    "done",
+    "last_edited_time",
+)
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _connect():
+    """Open a connection to the mirror DB, creating the tables on first use."""
+    global _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                _ensure_tables()
+                _initialized = True
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _ensure_tables():
+    """Create mirror tables and indexes if missing. Lives in the same DB file as the counters."""
+    DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id TEXT PRIMARY KEY,
+                project_id TEXT,
+                priority TEXT NOT NULL DEFAULT '',
+                title TEXT NOT NULL DEFAULT '',
+                planned_start TEXT NOT NULL DEFAULT '',
+                due_date TEXT NOT NULL DEFAULT '',
+                description TEXT NOT NULL DEFAULT '',
+                printed INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0,
+                last_edited_time TEXT NOT NULL DEFAULT ''
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_open ON tasks(done, printed, planned_start)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS projects (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL DEFAULT ''
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _row_values(row):
+    return tuple(row.get(col) if col not in ("printed", "done") else int(bool(row.get(col))) for col in TASK_COLUMNS)
+
+
+_UPSERT_SQL = (
+    f"INSERT INTO tasks({', '.join(TASK_COLUMNS)}) VALUES({', '.join('?' for _ in TASK_COLUMNS)}) "
+    "ON CONFLICT(id) DO UPDATE SET "
+    + ", ".join(f"{col}=excluded.{col}" for col in TASK_COLUMNS if col != "id")
+    + " WHERE excluded.last_edited_time >= tasks.last_edited_time AND ("
+    # skip no-op updates so re-fetched but unchanged pages don't bump the version
+    + " OR ".join(f"tasks.{col} IS NOT excluded.{col}" for col in TASK_COLUMNS if col != "id")
+    + ")"
+)
+
+
+def version():
+    """Return a counter that changes whenever the mirrored rows change, in any process sharing the DB.
+    Lets readers reuse work done for an unchanged mirror.
+    """
+    return int(get_state("version", 0))
+
+
+def _apply(conn, statements):
+    """Run (sql, params) statements in one transaction; every params tuple starts with a task id.
+    Returns the ids of the tasks that were actually changed.
+    """
+    changed = []
+    for sql, params in statements:
+        for values in params:
+            before = conn.total_changes
+            conn.execute(sql, values)
+            if conn.total_changes != before:
+                changed.append(values[0])
+    if changed:
+        # bumped in the same transaction, so no reader sees the new rows under the old version
+        conn.execute(
+            "INSERT INTO sync_state(name, value) VALUES('version', '1') "
+            "ON CONFLICT(name) DO UPDATE SET value=CAST(value AS INTEGER) + 1"
+        )
+    conn.commit()
+    return changed
+
+
+def upsert_tasks(rows):
+    """Insert or update mirrored tasks and return the ids of those that changed.
+    Rows older than the stored copy (by last_edited_time) are ignored.
+    """
+    conn = _connect()
+    try:
+        return _apply(conn, [(_UPSERT_SQL, [_row_values(r) for r in rows])])
+    finally:
+        conn.close()
+
+
+def replace_tasks(rows):
+    """Replace the whole mirror with rows (used by full syncs to drop deleted/archived pages).
+    Returns the ids of the tasks that changed or were dropped.
+    """
+    conn = _connect()
+    try:
+        keep = {r["id"] for r in rows}
+        gone = [(task_id,) for (task_id,) in conn.execute("SELECT id FROM tasks") if task_id not in keep]
+        return _apply(conn, [("DELETE FROM tasks WHERE id=?", gone), (_UPSERT_SQL, [_row_values(r) for r in rows])])
+    finally:
+        conn.close()
+
+
+def delete_tasks(task_ids):
+    """Drop mirrored tasks, e.g. pages that were deleted or moved out of the tasks data source.
+    Returns the ids of those that were mirrored.
+    """
+    conn = _connect()
+    try:
+        return _apply(conn, [("DELETE FROM tasks WHERE id=?", [(task_id,) for task_id in task_ids])])
+    finally:
+        conn.close()
+
+
+def tasks_to_print(today):
+    """Return rows that are not done, not printed and planned on/before today (or unplanned)."""
+    conn = _connect()
+    try:
+        cur = conn.execute(
+            "SELECT * FROM tasks WHERE done=0 AND printed=0 AND (planned_start='' OR substr(planned_start, 1, 10) <= ?)",
+            (today,),
+        )
+        return [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def todo_summary(today):
+    """Return rows that are not done and planned on/before today (or unplanned)."""
+    conn = _connect()
+    try:
+        cur = conn.execute(
+            "SELECT * FROM tasks WHERE done=0 AND (planned_start='' OR substr(planned_start, 1, 10) <= ?)",
+            (today,),
+        )
+        return [dict(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def get_task(task_id):
+    """Return the mirrored row for task_id, or None if it is not mirrored."""
+    conn = _connect()
+    try:
+        cur = conn.execute("SELECT * FROM tasks WHERE id=?", (task_id,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def get_state(name, default=None):
+    conn = _connect()
+    try:
+        cur = conn.execute("SELECT value FROM sync_state WHERE name=?", (name,))
+        row = cur.fetchone()
+        return row[0] if row else default
+    finally:
+        conn.close()
+
+
+def set_state(**values):
+    conn = _connect()
+    try:
+        conn.executemany(
+            "INSERT INTO sync_state(name, value) VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+            [(name, str(value)) for name, value in values.items()],
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def save_projects(projects, fetched_at):
+    """Persist the projects map (id -> name) and when it was fetched from Notion."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM projects")
+        conn.executemany("INSERT INTO projects(id, name) VALUES(?, ?)", list(projects.items()))
+        conn.execute(
+            "INSERT INTO sync_state(name, value) VALUES('projects_fetched_at', ?) ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+            (str(fetched_at),),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_projects():
+    """Return (projects map, fetched_at) as last saved, or None if projects were never saved."""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT value FROM sync_state WHERE name='projects_fetched_at'").fetchone()
+        if not row:
+            return None
+        projects = dict(conn.execute("SELECT id, name FROM projects").fetchall())
+        return projects, float(row[0])
+    finally:
+        conn.close()
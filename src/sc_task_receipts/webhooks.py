@@ -0,0 +1,43 @@
+import hmac
+import hashlib
+from sc_task_receipts import config
+from sc_task_receipts.metrics import WEBHOOK_EVENTS
+from sc_task_receipts.notion_api import refresh_page
+
+# Notion page events that can change a task's or project's properties, or whether it exists.
+# page.content_updated is left out: only page properties are read.
+PAGE_EVENTS = {"page.created", "page.properties_updated", "page.moved", "page.undeleted", "page.deleted"}
+
+
+def sign(body: bytes, secret: str):
+    """Return the X-Notion-Signature header value Notion sends for body."""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def verify(body: bytes, signature):
+    """Check a delivery's X-Notion-Signature against NOTION_WEBHOOK_SECRET (the subscription's verification token)."""
+    secret = config.get("NOTION_WEBHOOK_SECRET")
+    if not secret or not signature:
+        return False
+    return hmac.compare_digest(sign(body, secret), signature)
+
+
+async def handle(event):
+    """Apply one (verified) Notion event to the local caches and return what it changed.
+
+    Events only name the page, so the page is re-read from Notion; that also makes duplicate and
+    out-of-order deliveries harmless.
+    """
+    kind = event.get("type") or ""
+    entity = event.get("entity") or {}
+    if kind not in PAGE_EVENTS or entity.get("type") != "page" or not entity.get("id"):
+        result = "ignored"
+    else:
+        parent = (event.get("data") or {}).get("parent") or {}
+        result = await refresh_page(
+            entity["id"],
+            parent_ids=(parent.get("id"), parent.get("data_source_id")),
+            deleted=kind == "page.deleted",
+        )
+    WEBHOOK_EVENTS.labels(kind or "unknown", result).inc()
+    return result
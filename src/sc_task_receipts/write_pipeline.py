@@ -0,0 +1,153 @@
+import time
+import asyncio
+from notion_client import APIErrorCode, APIResponseError
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+# Errors worth another try: Notion asked us to slow down, or it was briefly unavailable
+_RETRYABLE_CODES = (APIErrorCode.RateLimited, APIErrorCode.InternalServerError, APIErrorCode.ServiceUnavailable, APIErrorCode.ConflictError)
+
+
+class TokenBucket:
+    """Async token bucket: `rate` requests per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Hold back every caller for `seconds`, e.g. after a 429 with Retry-After."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying `error`, or None if it should not be retried."""
+    if isinstance(error, RequestTimeoutError):
+        return min(2 ** attempt, 30)
+    if isinstance(error, APIResponseError) and error.code in _RETRYABLE_CODES:
+        retry_after = error.headers.get("Retry-After") if error.headers else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(2 ** attempt, 30)
+    if isinstance(error, HTTPResponseError) and error.status in (429, 502, 503, 504):
+        return min(2 ** attempt, 30)
+    return None
+
+
+class _PendingWrite:
+    __slots__ = ("properties", "future")
+
+    def __init__(self, properties, future):
+        self.properties = properties
+        self.future = future
+
+
+class WritePipeline:
+    """Run page updates on a small pool of workers behind a shared rate limiter.
+
+    Writes to a page that is still waiting in the queue are merged into one update (later
+    properties win) and every caller gets the result of that update. Only one update per page
+    is in flight at a time, so writes to the same page are applied in order.
+    """
+
+    def __init__(self, update, rate=3.0, workers=3, max_attempts=5):
+        self._update = update
+        self._bucket = TokenBucket(rate)
+        self._workers_count = workers
+        self._max_attempts = max_attempts
+        self._queue = None
+        self._workers = []
+        self._pending = {}
+        self._in_flight = set()
+        self.merged = 0
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._workers and self._workers[0].get_loop() is loop and not self._workers[0].done():
+            return
+        # (re)start on the current loop; queues and locks can't be shared across loops
+        self.close()
+        self._bucket = TokenBucket(self._bucket.rate, self._bucket.capacity)
+        self._queue = asyncio.Queue()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self._workers_count)]
+        # re-queue anything submitted before the workers were (re)started
+        for page_id in self._pending:
+            if page_id not in self._in_flight:
+                self._queue.put_nowait(page_id)
+
+    async def submit(self, page_id, properties):
+        """Queue an update of `properties` on `page_id` and return the updated page."""
+        self._ensure_workers()
+        pending = self._pending.get(page_id)
+        if pending is not None:
+            pending.properties.update(properties)
+            self.merged += 1
+            return await asyncio.shield(pending.future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[page_id] = _PendingWrite(dict(properties), future)
+        if page_id not in self._in_flight:
+            self._queue.put_nowait(page_id)
+        return await asyncio.shield(future)
+
+    async def _worker(self):
+        while True:
+            page_id = await self._queue.get()
+            write = self._pending.pop(page_id, None)
+            if write is None:
+                continue
+            self._in_flight.add(page_id)
+            try:
+                result = await self._run(page_id, write.properties)
+            except Exception as e:
+                if not write.future.done():
+                    write.future.set_exception(e)
+            else:
+                if not write.future.done():
+                    write.future.set_result(result)
+            finally:
+                self._in_flight.discard(page_id)
+                # a write for this page arrived while we were busy: it can go now
+                if page_id in self._pending:
+                    self._queue.put_nowait(page_id)
+
+    async def _run(self, page_id, properties):
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            try:
+                return await self._update(page_id=page_id, properties=properties)
+            except Exception as e:
+                attempt += 1
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt >= self._max_attempts:
+                    raise
+                if isinstance(e, APIResponseError) and e.code == APIErrorCode.RateLimited:
+                    # every worker backs off, not just this one
+                    self._bucket.pause(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
@@ -0,0 +1,131 @@
+"""Webhook endpoint tests: signed Notion events replayed against the app, backed by the local
+Notion stand-in (benchmarks/fake_notion.py) instead of the real API.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# same layout as `uvicorn --app-dir src`
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "src"))
+
+from benchmarks.fake_notion import FakeNotion, TASKS_ID, PROJECTS_ID
+from benchmarks.webhook_replayer import page_event, encode
+
+SECRET = "test-secret"
+
+
+@pytest.fixture(scope="module")
+def notion():
+    fake = FakeNotion().seed(tasks=20, projects=3)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture(scope="module")
+def client(notion):
+    from starlette.testclient import TestClient
+
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.update({
+        "NOTION_TOKEN": "test",
+        "NOTION_TASKS_ID": TASKS_ID,
+        "NOTION_PROJECTS_ID": PROJECTS_ID,
+        "NOTION_BASE_URL": notion.start(),
+        "NOTION_WEBHOOK_SECRET": SECRET,
+        "PRINTER_IP": "127.0.0.1",
+        "DB_PATH": str(Path(tmp.name) / "test.sqlite3"),
+        # after the startup sync the mirror never polls Notion again, so changes can only arrive through events
+        "TASK_SYNC_INTERVAL": "3600",
+        "TASK_MAX_STALENESS": "3600",
+    })
+    # settings are read at import time, so the app is only imported once the env points at the stand-in
+    from sc_task_receipts.main import app
+
+    # one event loop for the whole module, as the Notion client and the app's locks are bound to it
+    with TestClient(app) as client:
+        yield client
+    tmp.cleanup()
+
+
+def deliver(client, event, secret=SECRET):
+    body, headers = encode(event, secret)
+    return client.post("/api/v1/webhooks/notion", content=body, headers=headers)
+
+
+def tasks_by_id(client):
+    return {t["id"]: t for t in client.get("/api/v1/tasks").json()["data"]}
+
+
+def test_rejects_bad_signature(client, notion):
+    task_id = sorted(tasks_by_id(client))[0]
+    notion.edit(task_id, {"Name": "Not applied"})
+
+    assert deliver(client, page_event("page.properties_updated", task_id, TASKS_ID), secret="wrong").status_code == 401
+    body, headers = encode(page_event("page.properties_updated", task_id, TASKS_ID), None)
+    assert client.post("/api/v1/webhooks/notion", content=body, headers=headers).status_code == 401
+    assert tasks_by_id(client)[task_id]["title"] != "Not applied"
+
+
+def test_verification_handshake(client):
+    # sent once, unsigned, when the subscription is created
+    r = client.post("/api/v1/webhooks/notion", json={"verification_token": "secret_from_notion"})
+    assert r.status_code == 200
+    assert r.json()["message"] == "Verification token received"
+
+
+def test_properties_updated_refreshes_mirror_and_details(client, notion):
+    from sc_task_receipts import task_mirror
+
+    task_id = sorted(tasks_by_id(client))[1]
+    # cache the task's details first, so the event has to replace them
+    assert client.get(f"/api/v1/tasks/{task_id}").status_code == 200
+    notion.edit(task_id, {"Name": "Edited in Notion", "Priority": "Low"})
+
+    r = deliver(client, page_event("page.properties_updated", task_id, TASKS_ID))
+    assert r.status_code == 200
+    assert r.json()["message"] == "Event updated"
+    assert task_mirror.get_task(task_id)["title"] == "Edited in Notion"
+    assert tasks_by_id(client)[task_id]["title"] == "Edited in Notion"
+    details = client.get(f"/api/v1/tasks/{task_id}").json()["data"]
+    assert (details["title"], details["priority"]) == ("Edited in Notion", "Low")
+
+    # a duplicate delivery finds nothing left to change
+    assert deliver(client, page_event("page.properties_updated", task_id, TASKS_ID)).json()["message"] == "Event unchanged"
+
+
+def test_page_deleted_removes_task(client, notion):
+    from sc_task_receipts import task_mirror
+
+    task_id = sorted(tasks_by_id(client))[2]
+    notion.trash(task_id)
+
+    r = deliver(client, page_event("page.deleted", task_id, TASKS_ID))
+    assert r.status_code == 200
+    assert r.json()["message"] == "Event removed"
+    assert task_mirror.get_task(task_id) is None
+    assert task_id not in tasks_by_id(client)
+
+
+def test_project_rename_updates_its_tasks(client, notion):
+    tasks = tasks_by_id(client)
+    project_of = {t: notion.pages[t]["properties"]["Project"]["relation"] for t in tasks}
+    project_id = next(relation[0]["id"] for relation in project_of.values() if relation)
+    renamed = [t for t, relation in project_of.items() if relation == [{"id": project_id}]]
+    others = {t: tasks[t]["project"] for t in tasks if t not in renamed}
+    notion.edit(project_id, {"Name": "Renamed project"})
+
+    # no parent in the event: the app has to look the page up to see it's a project
+    r = deliver(client, page_event("page.properties_updated", project_id))
+    assert r.status_code == 200
+    assert r.json()["message"] == "Event updated"
+    tasks = tasks_by_id(client)
+    assert all(tasks[t]["project"] == "Renamed project" for t in renamed)
+    assert {t: tasks[t]["project"] for t in others} == others
+    assert client.get(f"/api/v1/tasks/{renamed[0]}").json()["data"]["project"] == "Renamed project"